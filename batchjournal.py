@@ -0,0 +1,244 @@
+"""Durable record of a running batch. Every completed segment and trailer
+is appended as a JSON line and synced to disk, so that a batch which was
+interrupted by a crash or a reboot can be resumed from where it stopped.
+The journal is deleted once its batch has run to the end, and it is
+locked for as long as its batch is running.
+"""
+try:
+    import fcntl
+except ImportError:
+    # Windows, journals are not locked there
+    fcntl = None
+import itertools
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+
+from clipsmaker import run_ffprobe
+from encoderprofile import EncoderProfile
+from utils import app_dir
+
+LOG = logging.getLogger("BatchJournal")
+
+JOURNAL_VERSION = 1
+
+# Segments and trailers are cut at packet boundaries, allow some slack
+# when comparing their duration with the requested one
+DURATION_TOLERANCE = 0.5
+
+# Batches of one process may start within the same second, and cancelled
+# ones keep their journal
+_journal_ids = itertools.count(1)
+
+def default_journal_dir():
+    return os.path.join(app_dir(), "journal")
+
+def find_unfinished(journal_dir):
+    """Journals left behind by batches that never finished, oldest
+    first. Journals of batches that are still running are left out
+    """
+    try:
+        file_names = sorted(os.listdir(journal_dir))
+    except OSError:
+        return []
+    return [os.path.join(journal_dir, file_name) for file_name in file_names
+            if file_name.endswith(".jsonl") and
+            not is_locked(os.path.join(journal_dir, file_name))]
+
+def is_locked(file_name):
+    """True if a running batch holds the journal file_name, or if it is
+    gone
+    """
+    if fcntl is None:
+        return False
+    try:
+        with open(file_name, "r") as journal_file:
+            try:
+                fcntl.flock(journal_file.fileno(),
+                            fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return True
+    except OSError:
+        return True
+    return False
+
+def verify_media(file_name, size, duration):
+    """True if file_name still has the recorded size and a duration close
+    to the requested one
+    """
+    try:
+        if os.path.getsize(file_name) != size:
+            return False
+    except OSError:
+        return False
+    info = run_ffprobe(file_name)
+    return (info is not None and
+            abs(info["duration"] - duration) <= DURATION_TOLERANCE)
+
+def job_to_record(job):
+    return {
+        "source": job.source,
+        "target": job.target,
+        "start_times": list(job.start_times),
+        "duration": job.duration,
+        "render_mode": job.render_mode,
+        "profile": job.profile._asdict() if job.profile else None
+    }
+
+class BatchJournal(object):
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.jobs = []
+        self.segments = {}
+        self.trailers = {}
+        self._file = None
+        self._is_locked = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, journal_dir, jobs):
+        os.makedirs(journal_dir, exist_ok=True)
+        journal = cls(os.path.join(journal_dir, "{}-{}-{}.jsonl".format(
+            time.strftime("%Y%m%d-%H%M%S"), os.getpid(),
+            next(_journal_ids))))
+        journal.jobs = [job_to_record(job) for job in jobs]
+        # Before the first write, nobody may take the batch for a crashed
+        # one
+        journal.lock()
+        journal.append({"event": "batch", "version": JOURNAL_VERSION,
+                        "jobs": journal.jobs})
+        return journal
+
+    @classmethod
+    def load(cls, file_name):
+        """Read a journal back. Returns None if it cannot be used"""
+        journal = cls(file_name)
+        try:
+            with open(file_name, "r") as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Most likely the write that was cut short
+                        LOG.warning("Skipping damaged record in %s",
+                                    file_name)
+                        continue
+                    journal.replay(record)
+        except OSError:
+            LOG.warning("Unable to read %s", file_name)
+            return None
+        if not journal.jobs:
+            return None
+        return journal
+
+    def lock(self):
+        """Lock the journal until it is closed, so that other processes do
+        not resume or discard a running batch. Returns False if another
+        process holds it
+        """
+        with self._lock:
+            if self._is_locked:
+                return True
+            if self._file is None:
+                self._file = open(self.file_name, "a")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self._file.fileno(),
+                                fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    self._file.close()
+                    self._file = None
+                    return False
+            self._is_locked = True
+            return True
+
+    def replay(self, record):
+        event = record.get("event")
+        if event == "batch" and record.get("version") == JOURNAL_VERSION:
+            self.jobs = record["jobs"]
+        elif event == "segment":
+            self.segments[(record["source"], record["index"])] = record
+        elif event == "trailer":
+            self.trailers[record["source"]] = record
+
+    def append(self, record):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.file_name, "a")
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.replay(record)
+
+    def add_segment(self, source, index, start_time, duration, file_name):
+        self.append({
+            "event": "segment",
+            "source": source,
+            "index": index,
+            "start_time": start_time,
+            "duration": duration,
+            "file": file_name,
+            "size": os.path.getsize(file_name)
+        })
+
+    def add_trailer(self, job):
+        self.append({
+            "event": "trailer",
+            "source": job.source,
+            "target": job.target,
+            "duration": len(job.start_times) * job.duration,
+            "size": os.path.getsize(job.target)
+        })
+
+    def find_segment(self, source, index, start_time, duration):
+        """File of a segment recorded with the same parameters that is
+        still intact, or None
+        """
+        record = self.segments.get((source, index))
+        if (record is None or record["start_time"] != start_time or
+                record["duration"] != duration):
+            return None
+        if not verify_media(record["file"], record["size"], duration):
+            LOG.info("Re-encoding damaged segment %s", record["file"])
+            return None
+        return record["file"]
+
+    def has_trailer(self, job):
+        record = self.trailers.get(job.source)
+        return (record is not None and record["target"] == job.target and
+                verify_media(job.target, record["size"],
+                             record["duration"]))
+
+    def get_jobs(self):
+        """The jobs of the batch as (source, target, start_times, duration,
+        render_mode, profile) tuples
+        """
+        return [(job["source"], job["target"], job["start_times"],
+                 job["duration"], job["render_mode"],
+                 EncoderProfile(**job["profile"]) if job["profile"]
+                 else None)
+                for job in self.jobs]
+
+    def get_sources(self):
+        return [job["source"] for job in self.jobs]
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                # Also releases the lock
+                self._file.close()
+                self._file = None
+            self._is_locked = False
+
+    def discard(self):
+        """Delete the journal, its batch is over"""
+        # Removed while still locked, so that no other process can lock
+        # and resume it in between
+        try:
+            os.remove(self.file_name)
+        except OSError:
+            LOG.warning("Unable to remove %s", self.file_name)
+        self.close()
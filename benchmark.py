@@ -0,0 +1,367 @@
+"""Benchmarks for the encoding pipeline and the GUI start-up. Sources are
+generated locally with ffmpeg's lavfi test patterns, so ffmpeg and ffprobe
+must be on PATH for everything except the start-up benchmark.
+
+    python benchmark.py render --length 1800 --num-clip 10
+    python benchmark.py profiles --length 600
+    python benchmark.py startup
+    python benchmark.py suite --output report.json --baseline base.json
+
+Nothing is downloaded, everything runs offline on the CPU.
+"""
+import argparse
+from collections import defaultdict
+import json
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from clipsmaker import (check_source, ClipsMaker, RENDER_COPY, RENDER_MODES,
+                        RENDER_SEGMENTS)
+from jobscheduler import EncodeJob, JobScheduler
+from metrics import METRICS
+from sourcecache import SourceCache
+
+# Suite sources as (size, length in seconds, container)
+SUITE_SOURCES = [
+    ("640x360", 120, ".mp4"),
+    ("1280x720", 600, ".mp4"),
+    ("1280x720", 600, ".mkv"),
+    ("1920x1080", 300, ".webm")
+]
+QUICK_SOURCES = [
+    ("640x360", 60, ".mp4"),
+    ("1280x720", 60, ".webm")
+]
+
+def make_source(path, length, size="1280x720", rate=25):
+    if path.endswith(".webm"):
+        codec_args = ["-c:v", "libvpx", "-deadline", "realtime",
+                      "-cpu-used", "8", "-b:v", "2M", "-c:a", "libvorbis"]
+    else:
+        codec_args = ["-c:v", "libx264", "-preset", "ultrafast", "-c:a",
+                      "aac"]
+    cmd = (["ffmpeg", "-hide_banner", "-v", "error", "-f", "lavfi", "-i",
+            "testsrc2=size={}:rate={}:duration={}".format(size, rate,
+                                                           length),
+            "-f", "lavfi", "-i", "sine=frequency=440:duration={}".format(
+                length), "-g", str(rate * 10)] + codec_args + ["-y", path])
+    subprocess.check_call(cmd)
+
+def time_call(func, repeat):
+    timings = []
+    for __ in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t_start)
+    return timings
+
+def print_timings(name, timings):
+    print("{:<16} best {:8.2f}s  mean {:8.2f}s".format(
+        name, min(timings), sum(timings) / len(timings)))
+
+def bench_render(args, work_dir):
+    source = os.path.join(work_dir, "source.mp4")
+    make_source(source, args.length)
+    jump = (args.length - args.duration) // args.num_clip
+    start_times = [j * jump for j in range(args.num_clip)]
+    scheduler = JobScheduler(args.workers)
+    for render_mode in RENDER_MODES:
+        extension = ".mkv" if render_mode == RENDER_COPY else ".webm"
+        target = os.path.join(work_dir, render_mode + extension)
+        job = EncodeJob(source, target, start_times, args.duration,
+                        render_mode)
+
+        def run():
+            __, success = scheduler.run([job])[0]
+            if not success:
+                raise SystemExit("{} render failed".format(render_mode))
+
+        print_timings(render_mode, time_call(run, args.repeat))
+
+def bench_profiles(args, work_dir):
+    """Encode the same trailer with every encoder profile, including the
+    ones in presets.ini, and compare speed against output size
+    """
+    source = os.path.join(work_dir, "source.mp4")
+    make_source(source, args.length)
+    jump = (args.length - args.duration) // args.num_clip
+    start_times = [j * jump for j in range(args.num_clip)]
+    trailer_length = args.num_clip * args.duration
+    # No segment cache, every run has to encode
+    scheduler = JobScheduler(args.workers)
+    profiles = ClipsMaker().get_profiles()
+    names = args.profile or sorted(profiles)
+    print("{:<16} {:>9} {:>9} {:>10} {:>10}".format(
+        "profile", "best", "speed", "size", "bitrate"))
+    for name in names:
+        if name not in profiles:
+            raise SystemExit("Unknown profile: {}".format(name))
+        target = os.path.join(work_dir, name + ".webm")
+        job = EncodeJob(source, target, start_times, args.duration,
+                        RENDER_SEGMENTS, profiles[name])
+
+        def run():
+            __, success = scheduler.run([job])[0]
+            if not success:
+                raise SystemExit("{} encode failed".format(name))
+
+        best = min(time_call(run, args.repeat))
+        size = os.path.getsize(target)
+        print("{:<16} {:8.2f}s {:8.2f}x {:8.2f}MB {:6.0f}kbit/s".format(
+            name, best, trailer_length / best, size / 1024 ** 2,
+            size * 8 / 1000 / trailer_length))
+
+def summarize(timings):
+    return {"best": min(timings), "mean": sum(timings) / len(timings),
+            "runs": len(timings)}
+
+def ffmpeg_version():
+    try:
+        output = subprocess.check_output(["ffmpeg", "-version"],
+                                         universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.splitlines()[0]
+
+def read_stage_times(metrics_file, offset):
+    """Wall times per stage recorded in metrics_file after offset"""
+    stage_times = defaultdict(list)
+    with open(metrics_file, "r") as records:
+        records.seek(offset)
+        for line in records:
+            record = json.loads(line)
+            stage_times[record["stage"]].append(record["wall_time"])
+    return stage_times
+
+def bench_check_options(num_jobs, num_clip, repeat):
+    # Jobs are added directly, this measures the option checks alone
+    maker = ClipsMaker()
+    for j in range(num_jobs):
+        maker.add_job("source_{}.mp4".format(j), "source_{}.webm".format(j),
+                      3600 + j % 600)
+    return time_call(lambda: maker.set_options("00:01:00", "", "3",
+                                               str(num_clip)), repeat)
+
+def bench_suite(args, work_dir):
+    """Time probing, option checks, per-clip encodes, concat and whole
+    trailers on generated sources. Writes a JSON report and compares it
+    with a baseline report
+    """
+    metrics_file = os.path.join(work_dir, "metrics.jsonl")
+    METRICS.configure(metrics_file)
+    results = {}
+
+    results["check_options_{}_jobs".format(args.num_jobs)] = summarize(
+        bench_check_options(args.num_jobs, args.num_clip, args.repeat))
+
+    scheduler = JobScheduler(args.workers)
+    for size, length, container in (QUICK_SOURCES if args.quick
+                                    else SUITE_SOURCES):
+        name = "{}_{}s{}".format(size, length, container.replace(".", "_"))
+        source = os.path.join(work_dir, "source_" + name + container)
+        print("Generating {}".format(name))
+        make_source(source, length, size)
+
+        def probe():
+            # A new cache every time so each call runs ffprobe
+            cache_file = os.path.join(work_dir, "cache.sqlite")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(cache_file + suffix):
+                    os.remove(cache_file + suffix)
+            if not check_source(source, SourceCache(cache_file))[0]:
+                raise SystemExit("check_source failed for {}".format(name))
+
+        results["check_source_" + name] = summarize(time_call(probe,
+                                                              args.repeat))
+
+        jump = (length - args.duration) // args.num_clip
+        start_times = [j * jump for j in range(args.num_clip)]
+        job = EncodeJob(source, os.path.join(work_dir, name + ".webm"),
+                        start_times, args.duration)
+        with open(metrics_file, "a"):
+            offset = os.path.getsize(metrics_file)
+
+        def run():
+            if not scheduler.run([job])[0][1]:
+                raise SystemExit("Trailer failed for {}".format(name))
+
+        timings = time_call(run, args.repeat)
+        stage_times = read_stage_times(metrics_file, offset)
+        results["trailer_" + name] = summarize(timings)
+        results["clip_encode_" + name] = summarize(stage_times["encode"])
+        results["concat_" + name] = summarize(stage_times["concat"])
+        # Seconds of trailer produced per second of wall time
+        results["throughput_" + name] = {
+            "best": args.num_clip * args.duration / min(timings),
+            "higher_is_better": True
+        }
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "ffmpeg": ffmpeg_version(),
+            "workers": scheduler.max_workers,
+            "num_clip": args.num_clip,
+            "duration": args.duration,
+            "repeat": args.repeat
+        },
+        "results": results
+    }
+    for name, result in sorted(results.items()):
+        print("{:<40} best {:10.3f}".format(name, result["best"]))
+    if args.output:
+        with open(args.output, "w") as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare_reports(baseline, report, args.threshold):
+            raise SystemExit(1)
+
+def compare_reports(baseline, report, threshold):
+    """Print the change of every result against baseline. Returns the
+    names of the results that got worse by more than threshold percent
+    """
+    regressions = []
+    print("\nCompared with baseline from {}:".format(
+        baseline["meta"].get("time")))
+    for name, result in sorted(report["results"].items()):
+        base = baseline["results"].get(name)
+        if base is None or not base["best"]:
+            print("{:<40} {:>10}".format(name, "new"))
+            continue
+        change = 100.0 * (result["best"] - base["best"]) / base["best"]
+        if result.get("higher_is_better"):
+            change = -change
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<40} {:+9.1f}%{}".format(name, change, flag))
+    return regressions
+
+def parse_import_times(stderr):
+    """Parse -X importtime output into {module: (self_us, cumulative_us)}"""
+    import_times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            import_times[fields[2].strip()] = (int(fields[0]),
+                                               int(fields[1]))
+        except (IndexError, ValueError):
+            continue
+    return import_times
+
+def bench_startup(args, work_dir):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, CLIPS_STARTUP_BENCHMARK="1")
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+    import_timings = []
+    paint_timings = []
+    import_times = {}
+    for __ in range(args.repeat):
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import clips"],
+            cwd=repo_dir, env=env, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        if process.returncode:
+            raise SystemExit("import clips failed:\n" + process.stderr[-2000:])
+        import_times = parse_import_times(process.stderr)
+        import_timings.append(import_times["clips"][1] / 1e6)
+
+        # Measured from spawning the interpreter until clips.py reports its
+        # first paint, i.e. what a user waits for
+        t_start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(repo_dir, "clips.py")],
+            cwd=work_dir, env=env, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        for line in process.stdout:
+            if line.strip() == "first_paint":
+                paint_timings.append(time.perf_counter() - t_start)
+                break
+        process.stdout.close()
+        process.wait(timeout=args.timeout)
+
+    print_timings("import clips", import_timings)
+    if paint_timings:
+        print_timings("first paint", paint_timings)
+    print("Slowest imports (self time):")
+    slowest = sorted(import_times.items(), key=lambda item: item[1][0],
+                     reverse=True)
+    for module, (self_us, __) in slowest[:args.top]:
+        print("  {:<40} {:8.1f}ms".format(module, self_us / 1e3))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    render_parser = subparsers.add_parser(
+        "render", help="compare the segment and filter graph render modes")
+    render_parser.add_argument("--length", type=int, default=1800,
+                               help="source length in seconds")
+    render_parser.add_argument("--num-clip", type=int, default=10)
+    render_parser.add_argument("--duration", type=int, default=3)
+    render_parser.add_argument("--workers", type=int, default=None)
+    render_parser.set_defaults(func=bench_render)
+
+    profiles_parser = subparsers.add_parser(
+        "profiles", help="compare encode speed and size of the encoder "
+        "profiles")
+    profiles_parser.add_argument("--length", type=int, default=600,
+                                 help="source length in seconds")
+    profiles_parser.add_argument("--num-clip", type=int, default=10)
+    profiles_parser.add_argument("--duration", type=int, default=3)
+    profiles_parser.add_argument("--workers", type=int, default=None)
+    profiles_parser.add_argument("--profile", action="append",
+                                 help="only this profile, may be repeated")
+    profiles_parser.set_defaults(func=bench_profiles)
+
+    suite_parser = subparsers.add_parser(
+        "suite", help="end-to-end timings with a JSON report")
+    suite_parser.add_argument("--quick", action="store_true",
+                              help="fewer and shorter sources")
+    suite_parser.add_argument("--num-jobs", type=int, default=10000,
+                              help="jobs for the check_options timing")
+    suite_parser.add_argument("--num-clip", type=int, default=10)
+    suite_parser.add_argument("--duration", type=int, default=3)
+    suite_parser.add_argument("--workers", type=int, default=None)
+    suite_parser.add_argument("--output", default=None,
+                              help="write the JSON report here")
+    suite_parser.add_argument("--baseline", default=None,
+                              help="JSON report to compare against")
+    suite_parser.add_argument("--threshold", type=float, default=10.0,
+                              help="percent slower that counts as a "
+                              "regression")
+    suite_parser.set_defaults(func=bench_suite)
+
+    startup_parser = subparsers.add_parser(
+        "startup", help="time importing clips.py and the first paint")
+    startup_parser.add_argument("--top", type=int, default=10,
+                                help="number of slowest imports to list")
+    startup_parser.add_argument("--timeout", type=int, default=30)
+    startup_parser.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp(prefix="clips-bench-")
+    try:
+        args.func(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
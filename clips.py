@@ -1,24 +1,40 @@
 import logging
+import os
 import sys
 
-from PyQt5.QtCore import QThread
+from PyQt5.QtCore import pyqtSignal, QCoreApplication, Qt, QThread
 from PyQt5.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QWidget
 
 from clipsmodel import ClipsModel
 from clipspresenter import ClipsPresenter
 from clipsview import ClipsView
 from filedialogview import FileDialogView
+from batchjournal import default_journal_dir
 from ffmpegworker import FfmpegWorker
+from probeworker import ProbeWorker
 from gfycatuploader import GfycatUploader
+from metrics import METRICS
+from segmentcache import SegmentCache
 
 class ClipsApp(QMainWindow):
     """Wrapper class for setting the main window"""
+    first_paint_sig = pyqtSignal()
+
     def __init__(self, parent=None):
         super().__init__(parent)
+        self._ffmpeg_worker = None
+        self._is_painted = False
+        self._threads = []
+        self._workers = []
 
         clips_model = ClipsModel()
-        clips_view = ClipsView()
+        clips_view = ClipsView(int(os.environ.get("CLIPS_LOG_LINES", 1000)))
+        if os.environ.get("CLIPS_STATUS_LOG"):
+            # Copy of the status log for post-mortems
+            clips_view.status_log_batcher.set_mirror(
+                os.environ["CLIPS_STATUS_LOG"])
         file_dialog_view = FileDialogView()
+        self.clips_view = clips_view
         self.clips_presenter = ClipsPresenter(clips_view, file_dialog_view,
                                               clips_model)
 
@@ -36,15 +52,83 @@ class ClipsApp(QMainWindow):
 
         self._set_style_sheet()
 
+    def connect_cancel(self, cancel):
+        self.clips_presenter.connect_cancel(cancel)
+
     def connect_ffmpeg(self, ffmpeg):
         self.clips_presenter.connect_ffmpeg(ffmpeg)
 
+    def connect_ffmpeg_resume(self, ffmpeg):
+        self.clips_presenter.connect_ffmpeg_resume(ffmpeg)
+
     def connect_gfycat(self, gfycat):
         self.clips_presenter.connect_gfycat(gfycat)
 
+    def connect_probe(self, probe_worker):
+        self.clips_presenter.connect_probe(probe_worker)
+
     def connect_status(self, signal):
         self.clips_presenter.connect_status(signal)
 
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self._is_painted:
+            self._is_painted = True
+            self.first_paint_sig.emit()
+
+    def start_workers(self):
+        """Create the worker threads. Called once the window is on screen
+        so that start-up only pays for what is needed to show it
+        """
+        ffmpeg_thread = QThread()
+        ffmpeg_thread.start()
+        # e.g. CLIPS_SCRATCH_DIR=/dev/shm keeps segments in memory
+        ffmpeg_worker = FfmpegWorker(
+            segment_cache=SegmentCache(),
+            scratch_dir=os.environ.get("CLIPS_SCRATCH_DIR"),
+            journal_dir=default_journal_dir())
+        ffmpeg_worker.moveToThread(ffmpeg_thread)
+
+        gfycat_thread = QThread()
+        gfycat_thread.start()
+        gfycat_uploader = GfycatUploader()
+        gfycat_uploader.moveToThread(gfycat_thread)
+
+        probe_thread = QThread()
+        probe_thread.start()
+        probe_worker = ProbeWorker()
+        probe_worker.moveToThread(probe_thread)
+
+        self.connect_ffmpeg(ffmpeg_worker.start_work)
+        self.connect_cancel(ffmpeg_worker.cancel)
+        self.connect_ffmpeg_resume(ffmpeg_worker.resume_work)
+        self.connect_status(ffmpeg_worker.status_sig)
+        self.connect_gfycat(gfycat_uploader.upload_from_file)
+        self.connect_status(gfycat_uploader.status_sig)
+        self.connect_probe(probe_worker)
+
+        self._ffmpeg_worker = ffmpeg_worker
+        # Keep the threads and workers alive for the lifetime of the window
+        self._threads.extend([ffmpeg_thread, gfycat_thread, probe_thread])
+        self._workers.extend([ffmpeg_worker, gfycat_uploader, probe_worker])
+
+        # Needs the worker, so only once it exists
+        self.clips_presenter.offer_resume()
+
+    def stop_workers(self):
+        # A running scan or batch would otherwise keep its thread from
+        # quitting until it is done
+        self.clips_presenter.cancel_scan()
+        if self._ffmpeg_worker is not None:
+            self._ffmpeg_worker.cancel()
+        for thread in self._threads:
+            thread.quit()
+            thread.wait()
+        # Deliver the workers' last messages and write out the lines still
+        # waiting for the next interval, they matter most in a post-mortem
+        QCoreApplication.sendPostedEvents()
+        self.clips_view.flush_log()
+
     def _set_style_sheet(self):
         self.setStyleSheet("""
             QLabel#option {
@@ -57,6 +141,11 @@ class ClipsApp(QMainWindow):
                 min-width: 60px;
                 width: 60px;
             }
+            QComboBox#render_mode {
+                max-width: 100px;
+                min-width: 100px;
+                width: 100px;
+            }
             QPushButton {
                 max-width: 100px;
                 min-width: 100px;
@@ -73,23 +162,19 @@ def qapp():
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
+    METRICS.configure_from_env()
     app = qapp()
 
-    ffmpeg_thread = QThread()
-    ffmpeg_thread.start()
-    ffmpeg_worker = FfmpegWorker()
-    ffmpeg_worker.moveToThread(ffmpeg_thread)
-
-    gfycat_thread = QThread()
-    gfycat_thread.start()
-    gfycat_uploader = GfycatUploader()
-    gfycat_uploader.moveToThread(gfycat_thread)
-
     window = ClipsApp()
-    window.connect_ffmpeg(ffmpeg_worker.start_work)
-    window.connect_status(ffmpeg_worker.status_sig)
-    window.connect_gfycat(gfycat_uploader.upload_from_file)
-    window.connect_status(gfycat_uploader.status_sig)
+    if os.environ.get("CLIPS_STARTUP_BENCHMARK"):
+        # Used by benchmark.py startup to time the first paint
+        window.first_paint_sig.connect(lambda: print("first_paint",
+                                                     flush=True))
+        window.first_paint_sig.connect(app.quit)
+    app.aboutToQuit.connect(window.stop_workers)
+    # Queued, so that the workers and a resume prompt only come once the
+    # first paint is done
+    window.first_paint_sig.connect(window.start_workers, Qt.QueuedConnection)
     window.show()
 
     app.exec_()
@@ -0,0 +1,228 @@
+"""Headless batch entry point. Runs the jobs of a JSON manifest without a
+display and without importing Qt:
+
+    {"jobs": [{"sources": ["a.mp4", "b.mkv"], "start_time": "00:01:00",
+               "end_time": "", "duration": 3, "num_clip": 10,
+               "preset": "name", "render_mode": "segments",
+               "profile": "vp8", "placement": "scenes"}]}
+
+Option fields override the named preset. One JSON result per source is
+written to stdout. Exit code is 0 if every source produced a trailer, 1
+if some did not and 2 if the manifest is unusable.
+"""
+import argparse
+import json
+import logging
+import signal
+import sys
+
+from batchjournal import find_unfinished
+from clipsmodel import ClipsModel
+from jobscheduler import JobScheduler, jobs_from_options
+from message import ProgressMessage
+from metrics import METRICS
+from segmentcache import SegmentCache
+
+LOG = logging.getLogger("ClipsCli")
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_BAD_MANIFEST = 2
+
+class ManifestError(Exception):
+    pass
+
+def load_manifest(file_name):
+    try:
+        if file_name == "-":
+            manifest = json.load(sys.stdin)
+        else:
+            with open(file_name, "r") as manifest_file:
+                manifest = json.load(manifest_file)
+    except (OSError, ValueError) as error:
+        raise ManifestError("Unable to read manifest: {}".format(error))
+    if isinstance(manifest, dict):
+        manifest = manifest.get("jobs")
+    if not isinstance(manifest, list):
+        raise ManifestError("Manifest must contain a list of jobs")
+    return manifest
+
+def print_result(source, target, status, info_str):
+    print(json.dumps({"source": source, "target": target, "status": status,
+                      "info": info_str}))
+    sys.stdout.flush()
+
+def job_status(scheduler, job, success):
+    if success:
+        return "done"
+    if scheduler.is_cancelled(job.source):
+        return "cancelled"
+    return "failed"
+
+def resolve_options(model, entry):
+    options = {}
+    if entry.get("preset"):
+        success, info = model.get_preset_options(entry["preset"])
+        if not success:
+            raise ManifestError("{}: {}".format(info, entry["preset"]))
+        options = dict(zip(["start_time", "end_time", "duration",
+                            "num_clip", "profile"], info))
+    for key in ("start_time", "end_time", "duration", "num_clip",
+                "profile"):
+        if entry.get(key) is not None:
+            options[key] = str(entry[key])
+    if any(not options.get(key) for key in ("start_time", "duration",
+                                            "num_clip")):
+        raise ManifestError("Missing options")
+    return (options["start_time"], options.get("end_time") or "",
+            options["duration"], options["num_clip"],
+            options.get("profile"))
+
+def run_entry(entry, scheduler, refresh_cache=False):
+    """Run one manifest entry and return True if every source produced a
+    trailer. With refresh_cache, the sources are probed and indexed again
+    instead of being served from the source cache
+    """
+    if not isinstance(entry, dict) or not entry.get("sources"):
+        raise ManifestError("Job without sources")
+    model = ClipsModel()
+    options = resolve_options(model, entry)
+    if options[4]:
+        success, info = model.set_profile(options[4])
+        if not success:
+            raise ManifestError("{}: {}".format(info, options[4]))
+    if entry.get("render_mode"):
+        success, info = model.set_render_mode(entry["render_mode"])
+        if not success:
+            raise ManifestError(info)
+    if entry.get("placement"):
+        success, info = model.set_placement(entry["placement"])
+        if not success:
+            raise ManifestError(info)
+
+    if refresh_cache:
+        model.invalidate_sources(entry["sources"])
+    model.add_sources(entry["sources"])
+    model.build_indexes()
+    all_ok = True
+    for source in dict.fromkeys(entry["sources"]):
+        if source not in model.maker.jobs:
+            print_result(source, None, "invalid", "Invalid source")
+            all_ok = False
+
+    results = model.set_options(*options[:4])
+    if results and results[0].index == -1:
+        raise ManifestError(results[0].info_str)
+    for result in results:
+        if not result.is_valid:
+            print_result(result.source_path, None, "invalid",
+                         result.info_str)
+            all_ok = False
+
+    valid_sources = set(result.source_path for result in results
+                        if result.is_valid)
+    jobs = [job for job in jobs_from_options(model.get_options())
+            if job.source in valid_sources]
+    for job, success in scheduler.run(jobs):
+        print_result(job.source, job.target,
+                     job_status(scheduler, job, success), None)
+        all_ok = all_ok and success
+    return all_ok
+
+def log_status(verbose):
+    def callback(message):
+        if verbose or not isinstance(message, ProgressMessage):
+            LOG.info("%s", message)
+    return callback
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Create trailers from a job manifest without a GUI")
+    parser.add_argument("manifest", nargs="?",
+                        help="JSON manifest, or - for stdin")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="maximum number of ffmpeg processes")
+    parser.add_argument("--sources", type=int, default=None,
+                        help="maximum number of sources in flight")
+    parser.add_argument("--segment-cache", default=None,
+                        help="segment cache directory")
+    parser.add_argument("--no-segment-cache", action="store_true")
+    parser.add_argument("--refresh-cache", action="store_true",
+                        help="drop the cached probe results and indexes of "
+                        "the sources before using them")
+    parser.add_argument("--scratch-dir", default=None,
+                        help="RAM-backed directory for segments, e.g. "
+                        "/dev/shm; falls back to disk when full")
+    parser.add_argument("--scratch-max", type=int, default=1024,
+                        help="MiB of the scratch directory to use at most")
+    parser.add_argument("--journal-dir", default=None,
+                        help="keep a journal of every batch here so that "
+                        "interrupted batches can be resumed")
+    parser.add_argument("--resume", action="store_true",
+                        help="first finish the interrupted batches in "
+                        "--journal-dir")
+    parser.add_argument("--metrics", default=None,
+                        help="JSON-lines metrics file")
+    parser.add_argument("--prometheus", default=None,
+                        help="Prometheus text-format metrics file")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="log encode progress")
+    args = parser.parse_args(argv)
+    if args.resume and args.journal_dir is None:
+        parser.error("--resume requires --journal-dir")
+    if args.manifest is None and not args.resume:
+        parser.error("a manifest is required")
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    if args.metrics or args.prometheus:
+        METRICS.configure(args.metrics, args.prometheus)
+    segment_cache = None
+    if not args.no_segment_cache:
+        segment_cache = SegmentCache(args.segment_cache)
+    scheduler = JobScheduler(args.workers, args.sources,
+                             log_status(args.verbose), segment_cache,
+                             scratch_dir=args.scratch_dir,
+                             scratch_max_bytes=args.scratch_max * 1024 ** 2,
+                             journal_dir=args.journal_dir)
+
+    # Stop the running ffmpeg processes and report the remaining sources
+    # as cancelled instead of dying with a traceback
+    interrupted = []
+
+    def on_signal(*args):
+        interrupted.append(True)
+        scheduler.cancel()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    all_ok = True
+    if args.resume:
+        for journal_file in find_unfinished(args.journal_dir):
+            # run() clears the cancellation, so stop here instead of
+            # resuming the next journal
+            if interrupted:
+                all_ok = False
+                break
+            for job, success in scheduler.resume(journal_file):
+                print_result(job.source, job.target,
+                             job_status(scheduler, job, success), None)
+                all_ok = all_ok and success
+    if args.manifest is None:
+        return EXIT_OK if all_ok else EXIT_FAILED
+
+    try:
+        entries = load_manifest(args.manifest)
+        for entry in entries:
+            if interrupted:
+                all_ok = False
+                break
+            all_ok = (run_entry(entry, scheduler, args.refresh_cache) and
+                      all_ok)
+    except ManifestError as error:
+        LOG.error("%s", error)
+        return EXIT_BAD_MANIFEST
+    return EXIT_OK if all_ok else EXIT_FAILED
+
+if __name__ == "__main__":
+    sys.exit(main())
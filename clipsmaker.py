@@ -1,49 +1,255 @@
+import bisect
 from collections import namedtuple
 from configparser import ConfigParser, DuplicateSectionError
+import json
 import logging
 import os.path
 import subprocess
-import sys
 
-from utils import try_parse_int64, try_parse_time
+from encoderprofile import (BUILTIN_PROFILES, DEFAULT_PROFILE,
+                            PROFILE_SECTION_PREFIX, profile_from_section,
+                            profile_to_section)
+from metrics import METRICS
+from sourcecache import get_default_cache
+from utils import app_dir, try_parse_int64, try_parse_time
 
 LOG = logging.getLogger("ClipMaker")
 
-def check_source(source_path):
+RENDER_SEGMENTS = "segments"
+RENDER_FILTERGRAPH = "filtergraph"
+RENDER_COPY = "copy"
+RENDER_MODES = (RENDER_SEGMENTS, RENDER_FILTERGRAPH, RENDER_COPY)
+
+PLACEMENT_FIXED = "fixed"
+PLACEMENT_SCENES = "scenes"
+PLACEMENTS = (PLACEMENT_FIXED, PLACEMENT_SCENES)
+
+INDEX_KEYFRAMES = "keyframes"
+INDEX_SCENES = "scenes"
+
+# Scene scores above this count as a cut
+SCENE_CUT_THRESHOLD = 0.3
+
+def run_ffprobe(source_path):
+    """Probe format and stream properties of source_path. Returns None if
+    ffprobe cannot read it
+    """
     cmd_ffprobe = ["ffprobe", "-v", "error", "-show_entries",
-                   "format=duration,format_name", "-of",
-                   "compact=print_section=0:nokey=1",
-                   source_path]
-    process = subprocess.Popen(cmd_ffprobe, stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT)
-    stdout, __ = process.communicate()
+                   "format=duration,format_name:"
+                   "stream=codec_type,codec_name,width,height",
+                   "-of", "json", source_path]
+    with METRICS.stage("probe", source_path) as stage:
+        process = subprocess.Popen(cmd_ffprobe, stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL)
+        with process.stdout:
+            stdout = process.stdout.read()
+        if stage.wait(process):
+            return None
     try:
-        format_name, source_len_str = stdout.decode("utf-8").split("|")
-        # Handle .txt files properly
-        if format_name == "tty":
-            raise ValueError
-        source_len = round(float(source_len_str))
-        target = os.path.splitext(source_path)[0] + ".webm"
-        info_str = "Valid: {}; Length: {}".format(source_path, source_len)
-        LOG.info(info_str)
-        return True, target, source_len
-    except (AttributeError, ValueError):
+        probe = json.loads(stdout.decode("utf-8"))
+        info = {
+            "format_name": probe["format"]["format_name"],
+            "duration": float(probe["format"]["duration"]),
+            "has_audio": False,
+            "video_codec": None,
+            "width": None,
+            "height": None
+        }
+    except (KeyError, ValueError):
+        return None
+    for stream in probe.get("streams", []):
+        if stream.get("codec_type") == "audio":
+            info["has_audio"] = True
+        elif (stream.get("codec_type") == "video" and
+              info["video_codec"] is None):
+            info["video_codec"] = stream.get("codec_name")
+            info["width"] = stream.get("width")
+            info["height"] = stream.get("height")
+    return info
+
+def probe_source(source_path, cache=None):
+    if cache is None:
+        cache = get_default_cache()
+    info = cache.get("probe", source_path)
+    if info is None:
+        info = run_ffprobe(source_path)
+        # Failed probes are not cached, the file may just be unreachable
+        if info is not None:
+            cache.put("probe", source_path, info)
+    return info
+
+def check_source(source_path, cache=None):
+    info = probe_source(source_path, cache)
+    # Handle .txt files properly
+    if info is None or info["format_name"] == "tty":
         info_str = "Invalid: {}".format(source_path)
         LOG.warning(info_str)
         return False, "", -1.0
+    source_len = round(info["duration"])
+    target = os.path.splitext(source_path)[0] + ".webm"
+    info_str = "Valid: {}; Length: {}".format(source_path, source_len)
+    LOG.info(info_str)
+    return True, target, source_len
+
+def has_audio_stream(source_path, cache=None):
+    info = probe_source(source_path, cache)
+    return info is not None and info["has_audio"]
+
+def probe_keyframes(source_path):
+    """Return the sorted keyframe timestamps of the first video stream,
+    or None if ffprobe fails. Only packet headers are read, nothing is
+    decoded
+    """
+    cmd_ffprobe = ["ffprobe", "-v", "error", "-select_streams", "v:0",
+                   "-show_entries", "packet=pts_time,flags", "-of",
+                   "csv=p=0", source_path]
+    with METRICS.stage("keyframes", source_path) as stage:
+        process = subprocess.Popen(cmd_ffprobe, stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL)
+        with process.stdout:
+            stdout = process.stdout.read()
+        if stage.wait(process):
+            return None
+    keyframes = []
+    for line in stdout.decode("utf-8").splitlines():
+        try:
+            pts_time, flags = line.split(",")[:2]
+            if "K" in flags:
+                keyframes.append(float(pts_time))
+        except ValueError:
+            continue
+    return sorted(keyframes)
+
+def snap_to_keyframe(keyframes, start_time, earliest, latest):
+    """Move start_time to the nearest keyframe between earliest and
+    latest. Returns None if there is no keyframe in that range
+    """
+    low = bisect.bisect_left(keyframes, earliest)
+    high = bisect.bisect_right(keyframes, latest)
+    idx = bisect.bisect_left(keyframes, start_time, low, high)
+    candidates = keyframes[max(idx - 1, low) : min(idx + 1, high)]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda t: abs(t - start_time))
+
+def run_scene_analysis(source_path, cut_threshold=SCENE_CUT_THRESHOLD):
+    """Decode source_path once, downscaled, and return its scene index:
+    the cut timestamps, the black intervals and the mean scene score of
+    every second as a measure of activity
+    """
+    cmd_ffmpeg = ["ffmpeg", "-hide_banner", "-nostats", "-i", source_path,
+                  "-an", "-sn", "-dn", "-vf",
+                  "scale=160:-2,blackdetect=d=0.5:pix_th=0.10,"
+                  "select=gte(scene\\,0),metadata=mode=print",
+                  "-f", "null", "-"]
+    cuts = []
+    black = []
+    activity = []
+    pts_time = 0.0
+    with METRICS.stage("scenes", source_path) as stage:
+        process = subprocess.Popen(cmd_ffmpeg, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+        # One line per frame, so parse while decoding instead of holding
+        # the whole log
+        with process.stderr:
+            for line in process.stderr:
+                try:
+                    if "pts_time:" in line:
+                        pts_time = float(
+                            line.split("pts_time:")[1].split()[0])
+                    elif "lavfi.scene_score=" in line:
+                        score = float(line.split("=")[-1])
+                        second = int(pts_time)
+                        while len(activity) <= second:
+                            activity.append([0.0, 0])
+                        activity[second][0] += score
+                        activity[second][1] += 1
+                        if score > cut_threshold:
+                            cuts.append(round(pts_time, 3))
+                    elif "black_start:" in line:
+                        fields = dict(field.split(":") for field
+                                      in line.split("]")[-1].split())
+                        black.append([float(fields["black_start"]),
+                                      float(fields["black_end"])])
+                except (IndexError, KeyError, ValueError):
+                    continue
+        if stage.wait(process):
+            return None
+    return {
+        "cuts": cuts,
+        "black": black,
+        "activity": [round(total / count, 4) if count else 0.0
+                     for total, count in activity]
+    }
+
+INDEX_BUILDERS = {
+    INDEX_KEYFRAMES: probe_keyframes,
+    INDEX_SCENES: run_scene_analysis
+}
+
+def build_index(kind, source_path, cache=None):
+    """Return the keyframe or scene index of source_path, building it if
+    it is not cached yet. Returns None if it cannot be built
+    """
+    if cache is None:
+        cache = get_default_cache()
+    index = cache.get(kind, source_path)
+    if index is None:
+        index = INDEX_BUILDERS[kind](source_path)
+        # Failed builds are not cached, the file may just be unreachable
+        if index is not None:
+            cache.put(kind, source_path, index)
+    return index
+
+def is_black(scenes, start_time, duration):
+    """True if more than half of the clip is black"""
+    overlap = sum(max(0.0, min(end, start_time + duration) -
+                      max(start, start_time))
+                  for start, end in scenes["black"])
+    return overlap > duration / 2
+
+def snap_to_scene(scenes, start_time, duration, earliest, latest, window):
+    """Move start_time to the nearest cut within window that does not
+    start before earliest or after latest and is not mostly black. Falls
+    back to the end of a black stretch and then to start_time itself
+    """
+    idx = bisect.bisect_left(scenes["cuts"], start_time - window)
+    candidates = []
+    for cut in scenes["cuts"][idx:]:
+        if cut > start_time + window:
+            break
+        if earliest <= cut <= latest and not is_black(scenes, cut,
+                                                      duration):
+            candidates.append(cut)
+    if candidates:
+        return min(candidates, key=lambda t: abs(t - start_time))
+    if is_black(scenes, start_time, duration):
+        for start, end in scenes["black"]:
+            if (start <= start_time < end and end <= latest and
+                    end - start_time <= window):
+                return end
+    return start_time
 
 class ClipJob(object):
     def __init__(self, source_path, target, source_length):
+        self.drifts = []
         self.is_valid = True
         self.jump = None
         self.source = source_path
         self.source_dir = os.path.dirname(source_path)
         self.source_length = source_length
+        self.start_times = []
         self.target = target
 
 class ClipsMaker(object):
     def __init__(self):
-        self.jobs = []
+        # Keyed by source path, in the order the sources were added
+        self.jobs = {}
+        # Position of every source in jobs
+        self._positions = {}
+        # (kind, source path) of the indexes that could not be built
+        self.failed_indexes = set()
 
         self.start_time_str = None
         self.start_time = None
@@ -52,17 +258,31 @@ class ClipsMaker(object):
         self.duration = None
         self.num_clip = None
         self.jump = None
+        self.render_mode = RENDER_SEGMENTS
+        self.placement = PLACEMENT_FIXED
+        self.profile_name = DEFAULT_PROFILE
 
-        self.config_file_name = os.path.join(
-            os.path.realpath(os.path.dirname(sys.argv[0])), "presets.ini")
-        open(self.config_file_name, "a").close()
-        self.config = ConfigParser()
-        self.config.read(self.config_file_name)
+        self.cache = get_default_cache()
+        self.config_file_name = os.path.join(app_dir(), "presets.ini")
+        self._config = None
+
+    @property
+    def config(self):
+        # Read on first use; a missing presets.ini is created on first save
+        if self._config is None:
+            self._config = ConfigParser()
+            self._config.read(self.config_file_name)
+        return self._config
 
     def add_job(self, source_path, target, source_length):
-        self.jobs.append(ClipJob(source_path, target, source_length))
+        if source_path not in self.jobs:
+            self._positions[source_path] = len(self.jobs)
+        self.jobs[source_path] = ClipJob(source_path, target, source_length)
 
-    def check_options(self):
+    def check_options(self, sources=None):
+        """Check the options against every job, or only against the jobs
+        of sources. Result.index is the job's position in the table
+        """
         if not self.jobs:
             return [Result(False, -1, "", "No source videos")]
 
@@ -79,9 +299,18 @@ class ClipsMaker(object):
             LOG.warning(info_str)
             return [Result(False, -1, "", info_str)]
 
+        if sources is None:
+            jobs = self.jobs.values()
+        else:
+            # Only the given jobs, so checking one source does not cost a
+            # pass over the whole table
+            jobs = [self.jobs[source] for source in dict.fromkeys(sources)
+                    if source in self.jobs]
         results = []
-        for idx, job in enumerate(self.jobs):
+        for job in jobs:
+            idx = self._positions[job.source]
             job.is_valid = False
+            indexes = self.get_indexes(job.source)
             if self.end_time is None:
                 working_duration = job.source_length - self.start_time
             else:
@@ -96,18 +325,100 @@ class ClipsMaker(object):
             elif trailer_duration > working_duration:
                 info_str = "Invalid no. of clips"
                 LOG.warning("%s: %s", info_str, job.source)
+            elif indexes is None:
+                info_str = "Waiting for the {} index".format(
+                    " and ".join(self.get_index_kinds()))
+                LOG.info("%s: %s", info_str, job.source)
             else:
                 job.is_valid = True
                 job.jump = working_duration // self.num_clip
+                job.start_times = [self.start_time + j * job.jump
+                                   for j in range(self.num_clip)]
+                job.drifts = []
                 info_str = ("{}s trailer using {} x {}s clips, "
                             "taken every {}s".format(
                                 trailer_duration, self.num_clip,
                                 self.duration, job.jump))
+                nominal = job.start_times
+                latest_start = (self.start_time + working_duration -
+                                self.duration)
+                if self.placement == PLACEMENT_SCENES:
+                    self._align_to_scenes(job, indexes.get(INDEX_SCENES),
+                                          latest_start)
+                if (self.render_mode == RENDER_COPY and
+                        not self._align_to_keyframes(
+                            job, indexes.get(INDEX_KEYFRAMES),
+                            latest_start)):
+                    job.is_valid = False
+                    info_str = "Clips do not fit between keyframes"
+                    LOG.warning("%s: %s", info_str, job.source)
+                elif job.start_times is not nominal:
+                    job.drifts = [start_time - nominal_time
+                                  for start_time, nominal_time
+                                  in zip(job.start_times, nominal)]
+                    info_str += "; drift: {}".format(", ".join(
+                        "{:+.2f}s".format(drift) for drift in job.drifts))
             results.append(Result(job.is_valid, idx, job.source, info_str))
         return results
 
+    def _align_to_keyframes(self, job, keyframes, latest_start):
+        """Start every clip on a keyframe, after the end of the previous
+        clip and early enough to leave room for the clips after it.
+        Returns False if the clips do not fit
+        """
+        if keyframes is None:
+            return True
+        start_times = []
+        earliest = self.start_time
+        for j, start_time in enumerate(job.start_times):
+            latest = latest_start - (len(job.start_times) - j - 1) * (
+                self.duration)
+            snapped = snap_to_keyframe(keyframes, start_time, earliest,
+                                       latest)
+            if snapped is None:
+                return False
+            start_times.append(snapped)
+            earliest = snapped + self.duration
+        job.start_times = start_times
+        return True
+
+    def _align_to_scenes(self, job, scenes, latest_start):
+        if scenes is None:
+            return
+        # Clips may move by up to half the gap between them, and never
+        # into the previous clip
+        window = max((job.jump - self.duration) / 2, 0)
+        start_times = []
+        earliest = self.start_time
+        for start_time in job.start_times:
+            snapped = snap_to_scene(scenes, start_time, self.duration,
+                                    earliest, latest_start, window)
+            start_times.append(snapped)
+            earliest = snapped + self.duration
+        job.start_times = start_times
+
     def clear_jobs(self):
         self.jobs.clear()
+        self._positions.clear()
+        self.failed_indexes.clear()
+
+    def has_options(self):
+        return self.start_time_str is not None
+
+    def is_preset_section(self, section):
+        return (section != "DEFAULT" and
+                not section.startswith(PROFILE_SECTION_PREFIX))
+
+    def remove_job(self, source_path):
+        del self.jobs[source_path]
+        self._positions = {source: idx for idx, source
+                           in enumerate(self.jobs)}
+        self.failed_indexes = set(entry for entry in self.failed_indexes
+                                  if entry[1] != source_path)
+
+    def write_config(self):
+        with open(self.config_file_name, "w") as config_file:
+            self.config.write(config_file)
 
     def save_options_as_preset(self, preset_name):
         try:
@@ -116,17 +427,18 @@ class ClipsMaker(object):
                 "start_time": self.start_time_str,
                 "end_time": self.end_time_str,
                 "duration": self.duration,
-                "num_clip": self.num_clip
+                "num_clip": self.num_clip,
+                "profile": self.profile_name
             }
-            with open(self.config_file_name, "w") as config_file:
-                self.config.write(config_file)
+            self.write_config()
             info_str = ("Saved preset '{}' - start_time: {}; end_time: {}; "
-                        "duration: {}; num_clip: {}".format(
+                        "duration: {}; num_clip: {}; profile: {}".format(
                             preset_name,
                             self.start_time_str,
                             self.end_time_str,
                             self.duration,
-                            self.num_clip))
+                            self.num_clip,
+                            self.profile_name))
             LOG.info(info_str)
             return True, info_str
         except DuplicateSectionError:
@@ -134,41 +446,156 @@ class ClipsMaker(object):
             LOG.warning(info_str)
             return False, info_str
 
+    def save_profile(self, profile):
+        """Store profile in presets.ini, replacing a profile of the same
+        name
+        """
+        self.config[PROFILE_SECTION_PREFIX + profile.name] = (
+            profile_to_section(profile))
+        self.write_config()
+        info_str = "Saved encoder profile '{}'".format(profile.name)
+        LOG.info(info_str)
+        return True, info_str
+
+    def get_indexes(self, source_path):
+        """Cached indexes of source_path that the placement and render
+        mode need, by kind. None while one of them has not been built;
+        indexes that could not be built are left out. Nothing is built
+        here, see build_index
+        """
+        indexes = {}
+        for kind in self.get_index_kinds():
+            index = self.cache.get(kind, source_path)
+            if index is not None:
+                indexes[kind] = index
+            elif (kind, source_path) not in self.failed_indexes:
+                return None
+        return indexes
+
+    def get_index_kinds(self):
+        kinds = []
+        if self.placement == PLACEMENT_SCENES:
+            kinds.append(INDEX_SCENES)
+        if self.render_mode == RENDER_COPY:
+            kinds.append(INDEX_KEYFRAMES)
+        return kinds
+
+    def get_unindexed(self, sources=None):
+        """The sources, or all sources, whose indexes are still missing"""
+        if not self.get_index_kinds():
+            return []
+        if sources is None:
+            sources = list(self.jobs)
+        return [source for source in sources if source in self.jobs and
+                self.get_indexes(source) is None]
+
     def get_options(self):
         return {
-            "source": [job.source for job in self.jobs],
-            "target": [job.target for job in self.jobs],
+            "source": [job.source for job in self.jobs.values()],
+            "target": [self.get_target(job) for job in self.jobs.values()],
             "start_time": self.start_time,
             "end_time": self.end_time,
             "duration": self.duration,
             "num_clip": self.num_clip,
-            "jump": [job.jump for job in self.jobs]
+            "jump": [job.jump for job in self.jobs.values()],
+            "start_times": [job.start_times for job in self.jobs.values()],
+            "render_mode": self.render_mode,
+            "profile": self.get_profile()
         }
 
+    def get_target(self, job):
+        # Stream-copied codecs are arbitrary, so fast previews go into a
+        # Matroska container instead of WebM
+        if self.render_mode == RENDER_COPY:
+            return os.path.splitext(job.target)[0] + ".mkv"
+        return job.target
+
     def get_presets(self):
         for section in self.config:
-            if section != "DEFAULT":
+            if self.is_preset_section(section):
                 yield ("{} - Start time: {}; End time: {}; Duration: {}; "
-                       "No. of clips: {}".format(
+                       "No. of clips: {}; Profile: {}".format(
                            section,
                            self.config[section]["start_time"],
                            self.config[section]["end_time"],
                            self.config[section]["duration"],
-                           self.config[section]["num_clip"]))
+                           self.config[section]["num_clip"],
+                           self.config[section].get("profile",
+                                                    DEFAULT_PROFILE)))
 
     def get_preset_options(self, preset_name):
         try:
-            if preset_name == "Select preset":
+            if (preset_name == "Select preset" or
+                    not self.is_preset_section(preset_name)):
                 raise AttributeError
+            # Presets saved before profiles existed use the default one
             return True, (self.config[preset_name]["start_time"],
                           self.config[preset_name]["end_time"],
                           self.config[preset_name]["duration"],
-                          self.config[preset_name]["num_clip"])
-        except AttributeError:
+                          self.config[preset_name]["num_clip"],
+                          self.config[preset_name].get("profile",
+                                                       DEFAULT_PROFILE))
+        except (AttributeError, KeyError):
             info_str = "Invalid preset"
             LOG.warning(info_str)
             return False, info_str
 
+    def get_profile(self, profile_name=None):
+        return self.get_profiles().get(profile_name or self.profile_name)
+
+    def get_profiles(self):
+        """Built-in profiles, overridden by those in presets.ini"""
+        profiles = dict(BUILTIN_PROFILES)
+        for section in self.config:
+            if section.startswith(PROFILE_SECTION_PREFIX):
+                name = section[len(PROFILE_SECTION_PREFIX) :]
+                profile = profile_from_section(name, self.config[section])
+                if profile is not None:
+                    profiles[name] = profile
+        return profiles
+
+    def set_indexed(self, source_path, kinds):
+        """Record that building the kinds of index of source_path has been
+        attempted. Those that are still not cached failed, clips of
+        source_path are placed without them
+        """
+        for kind in kinds:
+            if self.cache.get(kind, source_path) is None:
+                LOG.warning("No %s index: %s", kind, source_path)
+                self.failed_indexes.add((kind, source_path))
+
+    def set_profile(self, profile_name):
+        if self.get_profile(profile_name) is None:
+            info_str = "Invalid encoder profile"
+            LOG.warning(info_str)
+            return False, info_str
+        self.profile_name = profile_name
+        return True, profile_name
+
+    def set_placement(self, placement):
+        if placement not in PLACEMENTS:
+            info_str = "Invalid placement"
+            LOG.warning(info_str)
+            return False, info_str
+        if placement != self.placement:
+            self.placement = placement
+            if self.num_clip is not None:
+                self.check_options()
+        return True, placement
+
+    def set_render_mode(self, render_mode):
+        if render_mode not in RENDER_MODES:
+            info_str = "Invalid render mode"
+            LOG.warning(info_str)
+            return False, info_str
+        if render_mode != self.render_mode:
+            self.render_mode = render_mode
+            # Start times depend on the mode, so refresh them for the
+            # options that are already set
+            if self.num_clip is not None:
+                self.check_options()
+        return True, render_mode
+
     def set_options(self, start_time_str, end_time_str, duration, num_clip):
         self.start_time_str = start_time_str
         self.start_time = try_parse_time(start_time_str)
@@ -1,40 +1,136 @@
-from clipsmaker import check_source, ClipsMaker
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from batchjournal import BatchJournal, default_journal_dir, find_unfinished
+from clipsmaker import (build_index, check_source, ClipsMaker, PLACEMENTS,
+                        RENDER_MODES)
+
+SOURCE_NEW = "new"
+SOURCE_ENCODING = "encoding"
+SOURCE_ENCODED = "encoded"
+SOURCE_FAILED = "failed"
+SOURCE_CANCELLED = "cancelled"
+SOURCE_UPLOADING = "uploading"
+SOURCE_PUBLISHED = "published"
+
+# ffprobe is mostly waiting on process start-up and storage, so probe
+# more files at once than there are cores
+PROBE_WORKERS = 16
+# Scene indexes decode the whole source, so build one per core
+INDEX_WORKERS = os.cpu_count() or 1
 
 class ClipsModel(object):
     def __init__(self):
         self.maker = ClipsMaker()
-        self.file_names = []
-        self._is_created = False
-
-    def update_sources(self):
-        valid_file_names = []
-        self.maker.clear_jobs()
-        for file_name in self.file_names:
-            is_valid, target, length = check_source(file_name)
-            if is_valid and file_name not in valid_file_names:
-                valid_file_names.append(file_name)
-                self.maker.add_job(file_name, target, length)
-        self.file_names = valid_file_names
+        self._is_pipeline = False
+        # Per-source progress through encode and upload
+        self._states = {}
+
+    @property
+    def file_names(self):
+        return list(self.maker.jobs)
+
+    def add_probed_source(self, file_name, is_valid, target, length):
+        """Add the result of probing file_name, as produced by
+        check_source. Returns check results for the added job
+        """
+        if not is_valid or file_name in self.maker.jobs:
+            return []
+        self.maker.add_job(file_name, target, length)
+        if self.maker.has_options():
+            return self.maker.check_options([file_name])
+        return []
+
+    def add_sources(self, file_names):
+        """Probe the file names that are not in the job table yet and add
+        the valid ones. Returns check results for the added jobs only
+        """
+        file_names = self.get_new_sources(file_names)
+        added = []
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+            # map() returns results in input order
+            results = executor.map(check_source, file_names)
+            for file_name, (is_valid, target, length) in zip(file_names,
+                                                             results):
+                if is_valid:
+                    added.append(file_name)
+                    self.maker.add_job(file_name, target, length)
+        if added and self.maker.has_options():
+            return self.maker.check_options(added)
+        return []
+
+    def build_indexes(self, file_names=None):
+        """Build the indexes that the settings need for file_names, or for
+        every source, and wait for them. The GUI builds them on the
+        ProbeWorker instead
+        """
+        kinds = self.get_index_kinds()
+        file_names = self.get_unindexed_sources(file_names)
+
+        def build(file_name):
+            for kind in kinds:
+                build_index(kind, file_name, self.maker.cache)
+
+        with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as executor:
+            list(executor.map(build, file_names))
+        for file_name in file_names:
+            self.set_indexed(file_name, kinds)
 
     def check_options(self):
-        return (all([job.is_valid for job in self.maker.jobs]) and
+        return (all([job.is_valid and job.start_times
+                     for job in self.maker.jobs.values()]) and
                 self.maker.jobs)
 
-    def clear_file_names(self):
-        self.file_names.clear()
+    def check_sources(self, file_names):
+        """Check the options against file_names again, e.g. once their
+        indexes are built
+        """
+        if self.maker.has_options():
+            return self.maker.check_options(file_names)
+        return []
+
+    def clear_sources(self):
+        self.maker.clear_jobs()
+        self._states.clear()
 
     def create(self):
-        self._is_created = False
         if self.check_options():
+            for source in self.maker.jobs:
+                self._states[source] = SOURCE_ENCODING
             return True, "Running"
         else:
             return False, "Invalid configuration"
 
-    def extend_file_names(self, file_names):
-        self.file_names.extend(file_names)
-
-    def remove_file_name(self, file_name):
-        self.file_names.remove(file_name)
+    def invalidate_sources(self, file_names=None):
+        if file_names is None:
+            self.maker.cache.clear()
+        else:
+            for file_name in file_names:
+                self.maker.cache.invalidate(file_name)
+
+    def discard_batch(self, journal_file):
+        journal = BatchJournal(journal_file)
+        # Leave the journal of a batch that is running elsewhere alone
+        if journal.lock():
+            journal.discard()
+
+    def remove_source(self, file_name):
+        try:
+            self.maker.remove_job(file_name)
+        except KeyError:
+            raise ValueError("Unknown source: {}".format(file_name))
+        self._states.pop(file_name, None)
+
+    def start_upload(self, sources=None):
+        """Mark the encoded sources (or the given ones) as uploading and
+        return their targets
+        """
+        if sources is None:
+            sources = self.get_sources(SOURCE_ENCODED)
+        for source in sources:
+            self._states[source] = SOURCE_UPLOADING
+        return [self.maker.get_target(self.maker.jobs[source])
+                for source in sources]
 
     def save_preset(self, preset_name):
         return self.maker.save_options_as_preset(preset_name)
@@ -42,30 +138,92 @@ class ClipsModel(object):
     # =================================================================
     # Getters
     # =================================================================
-    def get_is_created(self):
-        return self._is_created
+    def get_is_pipeline(self):
+        return self._is_pipeline
+
+    def get_batch_sources(self, journal_file):
+        journal = BatchJournal.load(journal_file)
+        return journal.get_sources() if journal is not None else []
+
+    def get_index_kinds(self):
+        return self.maker.get_index_kinds()
 
     def get_jobs(self):
-        return self.maker.jobs
+        return list(self.maker.jobs.values())
+
+    def get_new_sources(self, file_names):
+        """The file names that are not in the job table yet"""
+        # dict keeps the first occurrence of each name in the user's order
+        return [file_name for file_name in dict.fromkeys(file_names)
+                if file_name not in self.maker.jobs]
 
     def get_options(self):
         return self.maker.get_options()
 
+    def get_unfinished_batches(self):
+        return find_unfinished(default_journal_dir())
+
+    def get_unindexed_sources(self, file_names=None):
+        return self.maker.get_unindexed(file_names)
+
+    def get_targets(self):
+        return [self.maker.get_target(job)
+                for job in self.maker.jobs.values()]
+
+    def get_placements(self):
+        return PLACEMENTS
+
     def get_presets(self):
         return self.maker.get_presets()
 
+    def get_profiles(self):
+        return sorted(self.maker.get_profiles())
+
+    def get_render_modes(self):
+        return RENDER_MODES
+
+    def get_sources(self, state):
+        return [source for source in self.maker.jobs
+                if self.get_state(source) == state]
+
+    def get_source_for_target(self, target):
+        for source, job in self.maker.jobs.items():
+            if self.maker.get_target(job) == target:
+                return source
+        return None
+
+    def get_state(self, source):
+        return self._states.get(source, SOURCE_NEW)
+
     def get_preset_options(self, preset_name):
         return self.maker.get_preset_options(preset_name)
 
     # =================================================================
     # Setters
     # =================================================================
-    def set_file_names(self, file_names):
-        self.file_names = file_names
+    def set_indexed(self, file_name, kinds):
+        self.maker.set_indexed(file_name, kinds)
 
-    def set_is_created(self, is_created):
-        self._is_created = is_created
+    def set_is_pipeline(self, is_pipeline):
+        self._is_pipeline = is_pipeline
 
     def set_options(self, start_time, end_time, duration, num_clip):
         return self.maker.set_options(start_time, end_time, duration,
                                       num_clip)
+
+    def set_placement(self, placement):
+        return self.maker.set_placement(placement)
+
+    def set_profile(self, profile_name):
+        return self.maker.set_profile(profile_name)
+
+    def set_render_mode(self, render_mode):
+        return self.maker.set_render_mode(render_mode)
+
+    def set_sources(self, file_names):
+        self.clear_sources()
+        return self.add_sources(file_names)
+
+    def set_state(self, source, state):
+        if source in self.maker.jobs:
+            self._states[source] = state
@@ -1,63 +1,215 @@
 import logging
 import os.path
 
-from PyQt5.QtCore import pyqtSignal, pyqtSlot, QObject
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QObject, Qt
 
-from message import ErrorMessage, InfoMessage, Message
+from clipsmodel import (SOURCE_CANCELLED, SOURCE_ENCODED, SOURCE_ENCODING,
+                        SOURCE_FAILED, SOURCE_PUBLISHED, SOURCE_UPLOADING)
+from message import (ErrorMessage, GfycatUploaderError, InfoMessage,
+                     JobCancelledMessage, JobFailedMessage,
+                     JobFinishedMessage, Message, UploadFinishedMessage)
 
 LOG = logging.getLogger("ClipsPresenter")
 
 class ClipsPresenter(QObject):
+    ffmpeg_cancel_sig = pyqtSignal(object)
     ffmpeg_create_sig = pyqtSignal(dict)
+    ffmpeg_resume_sig = pyqtSignal(str)
     gfycat_upload_sig = pyqtSignal(list)
+    index_sig = pyqtSignal(int, list, list)
+    probe_cancel_sig = pyqtSignal(int)
+    probe_sig = pyqtSignal(int, list)
 
     def __init__(self, clips_view, file_dialog_view, model):
         super().__init__()
         self.clips_view = clips_view
         self.file_dialog_view = file_dialog_view
         self.model = model
+        # Scans are numbered, results of scans before _first_scan_id were
+        # superseded by Browse
+        self._scan_id = 0
+        self._first_scan_id = 1
+        # Scan of the sources whose indexes are being built
+        self._indexing = {}
+        # Journal of the batch to resume once each of these scans is done
+        self._resumes = {}
 
         self.clips_view.update_combo_box(self.model.get_presets())
+        self.clips_view.update_render_modes(self.model.get_render_modes())
+        self.clips_view.update_profiles(self.model.get_profiles())
+        self.clips_view.update_placements(self.model.get_placements())
 
         self.clips_view.button_add_sig.connect(self.add_files)
         self.clips_view.button_browse_sig.connect(self.browse_for_file)
+        self.clips_view.button_cancel_sig.connect(self.cancel_current_file)
+        self.clips_view.button_cancel_all_sig.connect(self.cancel_all)
         self.clips_view.button_create_sig.connect(self.create)
         self.clips_view.button_load_sig.connect(self.set_options_with_preset)
         self.clips_view.button_preview_sig.connect(self.preview_clip_info)
         self.clips_view.button_save_sig.connect(self.save_preset)
         self.clips_view.button_remove_sig.connect(self.remove_current_file)
+        self.clips_view.button_stop_sig.connect(self.cancel_scan)
         self.clips_view.button_upload_sig.connect(self.upload)
 
     def add_files(self):
-        file_names = self.file_dialog_view.browse_for_files()
-        self.model.extend_file_names([name for name in file_names
-                                      if name not in self.model.file_names])
-        self.model.update_sources()
-        self.update_file_names()
+        self.start_scan(self.file_dialog_view.browse_for_files())
+
+    @pyqtSlot(int, str, list)
+    def add_indexed_file(self, scan_id, file_name, kinds):
+        self._indexing.pop(file_name, None)
+        if scan_id < self._first_scan_id:
+            return
+        self.model.set_indexed(file_name, kinds)
+        self.show_results(self.model.check_sources([file_name]))
+
+    @pyqtSlot(int, str, bool, str, int)
+    def add_probed_file(self, scan_id, file_name, is_valid, target, length):
+        if scan_id < self._first_scan_id:
+            return
+        results = self.model.add_probed_source(file_name, is_valid, target,
+                                               length)
+        self.clips_view.add_file_name(file_name, is_valid, length)
+        if scan_id in self._resumes:
+            self.model.set_state(file_name, SOURCE_ENCODING)
+            self.update_states([file_name])
+        if not is_valid:
+            self.clips_view.set_info(ErrorMessage("{} - Invalid".format(
+                os.path.basename(file_name))))
+        self.show_results(results)
+
+    def apply_settings(self):
+        """Pass the render mode, encoder profile and clip placement of the
+        view to the model. Returns False if one of them is invalid
+        """
+        for setter, value in [
+                (self.model.set_render_mode,
+                 self.clips_view.get_render_mode()),
+                (self.model.set_profile, self.clips_view.get_profile()),
+                (self.model.set_placement, self.clips_view.get_placement())]:
+            success, info = setter(value)
+            if not success:
+                self.clips_view.set_info(ErrorMessage(info))
+                return False
+        self.start_indexing()
+        return True
 
     def browse_for_file(self):
-        self.model.clear_file_names()
-        self.model.set_file_names(self.file_dialog_view.browse_for_files())
-        self.model.update_sources()
+        file_names = self.file_dialog_view.browse_for_files()
+        # The new selection replaces whatever is still being checked
+        self.cancel_scan()
+        self._first_scan_id = self._scan_id + 1
+        self._indexing.clear()
+        self.model.clear_sources()
         self.update_file_names()
+        self.start_scan(file_names)
+
+    def cancel_all(self):
+        if not self.model.get_sources(SOURCE_ENCODING):
+            self.clips_view.set_info(ErrorMessage("Nothing to cancel"))
+            return
+        self.ffmpeg_cancel_sig.emit(None)
+
+    def cancel_current_file(self):
+        file_name = self.clips_view.get_current_file_name()
+        if self.model.get_state(file_name) != SOURCE_ENCODING:
+            self.clips_view.set_info(ErrorMessage("Not encoding"))
+            return
+        self.ffmpeg_cancel_sig.emit(file_name)
+
+    def cancel_scan(self):
+        self.probe_cancel_sig.emit(self._scan_id)
+
+    def connect_cancel(self, cancel):
+        # The worker's thread is busy with the batch, so a queued call
+        # would only run once there is nothing left to cancel
+        self.ffmpeg_cancel_sig.connect(cancel, Qt.DirectConnection)
 
     def connect_ffmpeg(self, ffmpeg):
         self.ffmpeg_create_sig.connect(ffmpeg)
 
+    def connect_ffmpeg_resume(self, ffmpeg):
+        self.ffmpeg_resume_sig.connect(ffmpeg)
+
     def connect_gfycat(self, gfycat):
         self.gfycat_upload_sig.connect(gfycat)
 
+    def connect_probe(self, probe_worker):
+        self.probe_sig.connect(probe_worker.probe)
+        # Direct, the worker's thread is busy with the scan to cancel
+        self.probe_cancel_sig.connect(probe_worker.cancel,
+                                      Qt.DirectConnection)
+        probe_worker.result_sig.connect(self.add_probed_file)
+        probe_worker.finished_sig.connect(self.finish_scan)
+        self.index_sig.connect(probe_worker.index)
+        probe_worker.index_result_sig.connect(self.add_indexed_file)
+        probe_worker.index_finished_sig.connect(self.finish_indexing)
+
     def connect_status(self, signal):
         signal.connect(self.update_status)
 
     def create(self):
+        if not self.apply_settings():
+            return
+        self.model.set_is_pipeline(self.clips_view.get_is_pipeline())
         success, info = self.model.create()
         if success:
+            self.update_states()
             self.ffmpeg_create_sig.emit(self.model.get_options())
             self.clips_view.set_info(InfoMessage(info))
         else:
             self.clips_view.set_info(ErrorMessage(info))
 
+    @pyqtSlot(int, bool)
+    def finish_indexing(self, scan_id, cancelled):
+        for file_name, index_scan_id in list(self._indexing.items()):
+            if index_scan_id == scan_id:
+                del self._indexing[file_name]
+        if scan_id < self._first_scan_id:
+            return
+        if cancelled:
+            self.clips_view.set_info(InfoMessage("Stopped indexing files"))
+        else:
+            self.clips_view.set_info(InfoMessage("Indexed all files"))
+            # The settings may have changed while the scan was running
+            self.start_indexing()
+
+    @pyqtSlot(int, bool)
+    def finish_scan(self, scan_id, cancelled):
+        journal_file = self._resumes.pop(scan_id, None)
+        if scan_id < self._first_scan_id:
+            return
+        if cancelled:
+            self.clips_view.set_info(InfoMessage("Stopped checking files"))
+            return
+        self.clips_view.set_info(InfoMessage("Checked all files"))
+        if journal_file is not None:
+            # The journal has everything to run the batch, the scan only
+            # put its sources in the list
+            self.clips_view.set_info(InfoMessage("Resuming"))
+            self.ffmpeg_resume_sig.emit(journal_file)
+        self.start_indexing()
+
+    def offer_resume(self):
+        """Ask whether to finish the batches that were interrupted by a
+        crash or a reboot
+        """
+        for journal_file in self.model.get_unfinished_batches():
+            sources = self.model.get_batch_sources(journal_file)
+            if not sources:
+                continue
+            if not self.clips_view.request_resume(len(sources)):
+                self.model.discard_batch(journal_file)
+                continue
+            # Sources are probed on the ProbeWorker like any others, the
+            # batch resumes once they are listed. A cancelled scan leaves
+            # the journal to be offered again on the next start
+            for source in sources:
+                # Only changes the sources that are already listed
+                self.model.set_state(source, SOURCE_ENCODING)
+            self.update_states(sources)
+            scan_id = self.start_scan(sources, force=True)
+            self._resumes[scan_id] = journal_file
+
     def preview_clip_info(self):
         self.set_options(self.clips_view.get_start_time(),
                          self.clips_view.get_end_time(),
@@ -67,10 +219,11 @@ class ClipsPresenter(QObject):
     def remove_current_file(self):
         file_name = self.clips_view.get_current_file_name()
         try:
-            self.model.remove_file_name(file_name)
-            self.clips_view.remove_current_file_name()
+            self.model.remove_source(file_name)
         except ValueError:
+            # Invalid files are listed but have no job
             pass
+        self.clips_view.remove_current_file_name()
 
     def save_preset(self):
         if not self.model.check_options():
@@ -91,19 +244,10 @@ class ClipsPresenter(QObject):
         if any(not option for option in [start_time, duration, num_clip]):
             self.clips_view.set_info(ErrorMessage("Missing options"))
             return
-        results = self.model.set_options(start_time, end_time, duration,
-                                         num_clip)
-        for result in results:
-            if result.index == -1:
-                self.clips_view.set_info(ErrorMessage(result.info_str))
-                break
-            self.clips_view.set_validity(result.index, result.is_valid)
-            message = "{} - {}".format(os.path.basename(result.source_path),
-                                       result.info_str)
-            if result.is_valid:
-                self.clips_view.set_info(InfoMessage(message))
-            else:
-                self.clips_view.set_info(ErrorMessage(message))
+        if not self.apply_settings():
+            return
+        self.show_results(self.model.set_options(start_time, end_time,
+                                                 duration, num_clip))
 
     def set_options_with_preset(self):
         preset_name = (self.clips_view.get_current_combo_box_text()
@@ -114,23 +258,106 @@ class ClipsPresenter(QObject):
             self.clips_view.set_end_time(info[1])
             self.clips_view.set_duration(info[2])
             self.clips_view.set_num_clip(info[3])
-            self.set_options(*info)
+            self.clips_view.set_profile(info[4])
+            self.set_options(*info[:4])
         else:
             self.clips_view.set_info(ErrorMessage(info))
 
+    def show_results(self, results):
+        for result in results:
+            if result.index == -1:
+                self.clips_view.set_info(ErrorMessage(result.info_str))
+                break
+            self.clips_view.set_validity(result.source_path, result.is_valid)
+            message = "{} - {}".format(os.path.basename(result.source_path),
+                                       result.info_str)
+            if result.is_valid:
+                self.clips_view.set_info(InfoMessage(message))
+            else:
+                self.clips_view.set_info(ErrorMessage(message))
+
+    def start_indexing(self):
+        """Build the scene and keyframe indexes that the settings need in
+        the background. Until then, the clips of the sources without them
+        are not placed and the options stay invalid
+        """
+        file_names = [file_name for file_name
+                      in self.model.get_unindexed_sources()
+                      if file_name not in self._indexing]
+        if not file_names:
+            return
+        self._scan_id += 1
+        for file_name in file_names:
+            self._indexing[file_name] = self._scan_id
+        self.clips_view.set_info(InfoMessage("Indexing {} files".format(
+            len(file_names))))
+        self.index_sig.emit(self._scan_id, file_names,
+                            self.model.get_index_kinds())
+
+    def start_scan(self, file_names, force=False):
+        """Probe the new file names in the background, every file is
+        listed as soon as its probe completes. Returns the scan's id, or
+        None if there is nothing new to probe unless force is set
+        """
+        file_names = self.model.get_new_sources(file_names)
+        if not file_names and not force:
+            return None
+        self._scan_id += 1
+        self.clips_view.set_info(InfoMessage("Checking {} files".format(
+            len(file_names))))
+        self.probe_sig.emit(self._scan_id, file_names)
+        return self._scan_id
+
     def update_file_names(self):
         self.clips_view.update_file_names(self.model.file_names)
+        for job in self.model.get_jobs():
+            self.clips_view.set_source_duration(job.source,
+                                                job.source_length)
+        self.update_states()
+
+    def update_states(self, sources=None):
+        """Show the state of sources, or of every source, in the list"""
+        if sources is None:
+            sources = self.model.file_names
+        for source in sources:
+            self.clips_view.set_status(source, self.model.get_state(source))
 
     @pyqtSlot(Message)
     def update_status(self, message):
         self.clips_view.set_info(message)
-        if message == InfoMessage("Done"):
-            self.model.set_is_created(True)
+        source = None
+        if isinstance(message, JobFinishedMessage):
+            source = message.source
+            self.model.set_state(source, SOURCE_ENCODED)
+            # In pipeline mode each trailer is uploaded while the next
+            # source is still encoding
+            if (self.model.get_is_pipeline() and
+                    self.model.get_state(source) == SOURCE_ENCODED):
+                self.gfycat_upload_sig.emit(
+                    self.model.start_upload([source]))
+        elif isinstance(message, JobFailedMessage):
+            source = message.source
+            self.model.set_state(source, SOURCE_FAILED)
+        elif isinstance(message, JobCancelledMessage):
+            source = message.source
+            self.model.set_state(source, SOURCE_CANCELLED)
+        elif isinstance(message, UploadFinishedMessage):
+            source = self.model.get_source_for_target(message.file_name)
+            self.model.set_state(source, SOURCE_PUBLISHED)
+        elif (isinstance(message, GfycatUploaderError) and
+              message.file_name is not None):
+            # The trailer itself is fine, allow uploading it again
+            source = self.model.get_source_for_target(message.file_name)
+            if self.model.get_state(source) == SOURCE_UPLOADING:
+                self.model.set_state(source, SOURCE_ENCODED)
+        if source is not None:
+            self.update_states([source])
 
     def upload(self):
-        if self.model.get_is_created():
+        targets = self.model.start_upload()
+        self.update_states()
+        if targets:
             self.clips_view.set_info(InfoMessage("Uploading"))
-            self.gfycat_upload_sig.emit([job.target
-                                         for job in self.model.get_jobs()])
+            self.gfycat_upload_sig.emit(targets)
         else:
             self.clips_view.set_info(ErrorMessage("Trailer not created"))
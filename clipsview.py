@@ -1,24 +1,30 @@
-from datetime import datetime
-
 from PyQt5.QtCore import pyqtSignal, Qt
-from PyQt5.QtGui import QTextCursor
-from PyQt5.QtWidgets import (QComboBox, QHBoxLayout, QInputDialog, QLabel,
-                             QLineEdit, QListWidget, QPushButton, QTextEdit,
+from PyQt5.QtWidgets import (QCheckBox, QComboBox, QHBoxLayout,
+                             QInputDialog, QLabel, QLineEdit, QListView,
+                             QMessageBox, QPlainTextEdit, QPushButton,
                              QVBoxLayout, QWidget)
 
+from sourcelistmodel import SourceListModel
+from statuslog import StatusLogBatcher
+
 class ClipsView(QWidget):
     button_add_sig = pyqtSignal()
     button_browse_sig = pyqtSignal()
+    button_cancel_sig = pyqtSignal()
+    button_cancel_all_sig = pyqtSignal()
     button_create_sig = pyqtSignal()
     button_load_sig = pyqtSignal()
     button_preview_sig = pyqtSignal()
     button_remove_sig = pyqtSignal()
+    button_stop_sig = pyqtSignal()
     button_save_sig = pyqtSignal()
     button_upload_sig = pyqtSignal()
 
-    def __init__(self):
+    def __init__(self, max_log_lines=1000):
         super().__init__()
 
+        self.max_log_lines = max_log_lines
+        self.status_log_batcher = StatusLogBatcher(parent=self)
         self.vbox = QVBoxLayout()
         self.name_labels = []
         self._init_browse_ui()
@@ -35,13 +41,48 @@ class ClipsView(QWidget):
         for item in presets:
             self._combo_box_preset.addItem(item)
 
+    def update_render_modes(self, render_modes):
+        self._combo_box_render_mode.clear()
+        for item in render_modes:
+            self._combo_box_render_mode.addItem(item)
+
+    def update_placements(self, placements):
+        self._combo_box_placement.clear()
+        for item in placements:
+            self._combo_box_placement.addItem(item)
+
+    def update_profiles(self, profiles):
+        self._combo_box_profile.clear()
+        for item in profiles:
+            self._combo_box_profile.addItem(item)
+
+    def append_lines(self, lines):
+        scroll_bar = self._text_edit.verticalScrollBar()
+        # Only follow the log if the user has not scrolled back
+        at_bottom = scroll_bar.value() == scroll_bar.maximum()
+        self._text_edit.appendPlainText("\n".join(lines))
+        if at_bottom:
+            scroll_bar.setValue(scroll_bar.maximum())
+
+    def add_file_name(self, file_name, is_valid=True, duration=None):
+        self._source_list_model.append(file_name, is_valid, duration)
+
     def update_file_names(self, file_names):
-        self._list_widget_file_names.clear()
-        self._list_widget_file_names.addItems(file_names)
+        self._source_list_model.reset(file_names)
 
     def remove_current_file_name(self):
-        self._list_widget_file_names.takeItem(
-            self._list_widget_file_names.currentRow())
+        self._source_list_model.remove(
+            self._list_view_file_names.currentIndex().row())
+
+    def flush_log(self):
+        self.status_log_batcher.flush()
+
+    def request_resume(self, num_sources):
+        answer = QMessageBox.question(
+            self, "Resume batch",
+            "A batch of {} sources was interrupted. Resume it?".format(
+                num_sources))
+        return answer == QMessageBox.Yes
 
     def request_preset_name(self):
         return QInputDialog.getText(self, "Save preset",
@@ -56,6 +97,12 @@ class ClipsView(QWidget):
     def button_browse_clicked(self):
         self.button_browse_sig.emit()
 
+    def button_cancel_clicked(self):
+        self.button_cancel_sig.emit()
+
+    def button_cancel_all_clicked(self):
+        self.button_cancel_all_sig.emit()
+
     def button_create_clicked(self):
         self.button_create_sig.emit()
 
@@ -71,6 +118,9 @@ class ClipsView(QWidget):
     def button_save_clicked(self):
         self.button_save_sig.emit()
 
+    def button_stop_clicked(self):
+        self.button_stop_sig.emit()
+
     def button_upload_clicked(self):
         self.button_upload_sig.emit()
 
@@ -81,7 +131,8 @@ class ClipsView(QWidget):
         return self._combo_box_preset.currentText()
 
     def get_current_file_name(self):
-        return self._list_widget_file_names.currentItem().text()
+        return self._source_list_model.file_name(
+            self._list_view_file_names.currentIndex().row())
 
     def get_duration(self):
         return self._line_edit_duration.text()
@@ -89,9 +140,21 @@ class ClipsView(QWidget):
     def get_end_time(self):
         return self._line_edit_end_time.text()
 
+    def get_is_pipeline(self):
+        return self._check_box_pipeline.isChecked()
+
     def get_num_clip(self):
         return self._line_edit_num_clip.text()
 
+    def get_placement(self):
+        return self._combo_box_placement.currentText()
+
+    def get_profile(self):
+        return self._combo_box_profile.currentText()
+
+    def get_render_mode(self):
+        return self._combo_box_render_mode.currentText()
+
     def get_start_time(self):
         return self._line_edit_start_time.text()
 
@@ -105,23 +168,27 @@ class ClipsView(QWidget):
         return self._line_edit_end_time.setText(text)
 
     def set_info(self, text):
-        self._text_edit.append("{:02d}:{:02d}:{:02d} - {}".format(
-            datetime.now().hour, datetime.now().minute,
-            datetime.now().second, text))
-        self._text_edit.ensureCursorVisible()
-        self._text_edit.moveCursor(QTextCursor.End)
+        self.status_log_batcher.append(text)
 
     def set_num_clip(self, text):
         return self._line_edit_num_clip.setText(text)
 
+    def set_profile(self, text):
+        index = self._combo_box_profile.findText(text)
+        if index != -1:
+            self._combo_box_profile.setCurrentIndex(index)
+
+    def set_source_duration(self, file_name, duration):
+        self._source_list_model.set_values(file_name, duration=duration)
+
     def set_start_time(self, text):
         return self._line_edit_start_time.setText(text)
 
-    def set_validity(self, index, is_valid):
-        if is_valid:
-            self._list_widget_file_names.item(index).setForeground(Qt.black)
-        else:
-            self._list_widget_file_names.item(index).setForeground(Qt.red)
+    def set_status(self, file_name, status):
+        self._source_list_model.set_values(file_name, status=status)
+
+    def set_validity(self, file_name, is_valid):
+        self._source_list_model.set_values(file_name, is_valid=is_valid)
 
     # =================================================================
     # Initialize UI
@@ -129,8 +196,13 @@ class ClipsView(QWidget):
     def _init_browse_ui(self):
         label_file_name = QLabel("File name: ")
 
-        self._list_widget_file_names = QListWidget()
-        self._list_widget_file_names.setFixedHeight(100)
+        self._source_list_model = SourceListModel(self)
+        self._list_view_file_names = QListView()
+        # Rows all have the same height, so the view does not have to
+        # measure every one of them
+        self._list_view_file_names.setUniformItemSizes(True)
+        self._list_view_file_names.setModel(self._source_list_model)
+        self._list_view_file_names.setFixedHeight(100)
 
         button_browse = QPushButton("Browse")
         button_browse.clicked.connect(self.button_browse_clicked)
@@ -138,15 +210,19 @@ class ClipsView(QWidget):
         button_add.clicked.connect(self.button_add_clicked)
         button_remove = QPushButton("Remove")
         button_remove.clicked.connect(self.button_remove_clicked)
+        button_stop = QPushButton("Stop")
+        button_stop.setToolTip("Stop checking the files")
+        button_stop.clicked.connect(self.button_stop_clicked)
 
         vbox = QVBoxLayout()
         vbox.addWidget(button_browse)
         vbox.addWidget(button_add)
         vbox.addWidget(button_remove)
+        vbox.addWidget(button_stop)
 
         hbox = QHBoxLayout()
         hbox.addWidget(label_file_name)
-        hbox.addWidget(self._list_widget_file_names)
+        hbox.addWidget(self._list_view_file_names)
         hbox.addLayout(vbox)
 
         for i in range(hbox.count()):
@@ -201,17 +277,37 @@ class ClipsView(QWidget):
         self.vbox.addLayout(hbox)
 
     def _init_info_ui(self):
-        self._text_edit = QTextEdit()
+        self._text_edit = QPlainTextEdit()
         self._text_edit.setFixedHeight(80)
         self._text_edit.setReadOnly(True)
+        # The widget is the log, it drops the oldest lines itself
+        self._text_edit.setMaximumBlockCount(self.max_log_lines)
+        self.status_log_batcher.lines_sig.connect(self.append_lines)
+        self._combo_box_render_mode = QComboBox()
+        self._combo_box_render_mode.setObjectName("render_mode")
+        self._combo_box_profile = QComboBox()
+        self._combo_box_profile.setObjectName("render_mode")
+        self._combo_box_placement = QComboBox()
+        self._combo_box_placement.setObjectName("render_mode")
         button_create = QPushButton("Create")
         button_create.clicked.connect(self.button_create_clicked)
+        button_cancel = QPushButton("Cancel")
+        button_cancel.clicked.connect(self.button_cancel_clicked)
+        button_cancel_all = QPushButton("Cancel all")
+        button_cancel_all.clicked.connect(self.button_cancel_all_clicked)
         button_upload = QPushButton("Upload")
         button_upload.clicked.connect(self.button_upload_clicked)
+        self._check_box_pipeline = QCheckBox("Upload when done")
 
         vbox = QVBoxLayout()
+        vbox.addWidget(self._combo_box_render_mode)
+        vbox.addWidget(self._combo_box_profile)
+        vbox.addWidget(self._combo_box_placement)
         vbox.addWidget(button_create)
+        vbox.addWidget(button_cancel)
+        vbox.addWidget(button_cancel_all)
         vbox.addWidget(button_upload)
+        vbox.addWidget(self._check_box_pipeline)
 
         hbox = QHBoxLayout()
         hbox.addWidget(self._text_edit)
@@ -0,0 +1,99 @@
+"""Named libvpx settings. Built-in profiles can be extended or overridden
+by [profile:<name>] sections in presets.ini:
+
+    [profile:fast-vp9]
+    codec = libvpx-vp9
+    deadline = realtime
+    cpu_used = 8
+    crf = 36
+    bitrate = 0
+    row_mt = 1
+    tile_columns = 2
+"""
+from collections import namedtuple
+import logging
+
+LOG = logging.getLogger("EncoderProfile")
+
+PROFILE_SECTION_PREFIX = "profile:"
+
+EncoderProfile = namedtuple("EncoderProfile", [
+    "name", "codec", "deadline", "cpu_used", "bitrate", "crf", "row_mt",
+    "tile_columns", "audio_bitrate"])
+# Everything after name and codec is optional
+EncoderProfile.__new__.__defaults__ = (None, None, "3M", None, False, None,
+                                       "128k")
+
+BUILTIN_PROFILES = {
+    # Same output as before profiles existed
+    "vp8": EncoderProfile("vp8", "libvpx"),
+    "realtime": EncoderProfile("realtime", "libvpx", "realtime", 8),
+    "good": EncoderProfile("good", "libvpx-vp9", "good", 4, "0", 32, True,
+                           2),
+    "best": EncoderProfile("best", "libvpx-vp9", "best", None, "0", 30, True,
+                           2)
+}
+DEFAULT_PROFILE = "vp8"
+
+def codec_args(profile, threads=None):
+    """ffmpeg output arguments for profile. threads is left out of the
+    segment cache key, it does not change what libvpx produces
+    """
+    args = ["-c:v", profile.codec]
+    if profile.deadline is not None:
+        args.extend(["-deadline", profile.deadline])
+    if profile.cpu_used is not None:
+        args.extend(["-cpu-used", str(profile.cpu_used)])
+    if profile.crf is not None:
+        args.extend(["-crf", str(profile.crf)])
+    if profile.bitrate is not None:
+        # With crf, a bitrate of 0 selects constant quality mode
+        args.extend(["-b:v", profile.bitrate])
+    if profile.row_mt:
+        args.extend(["-row-mt", "1"])
+    if profile.tile_columns is not None:
+        args.extend(["-tile-columns", str(profile.tile_columns)])
+    if threads is not None:
+        args.extend(["-threads", str(threads)])
+    return args
+
+def parse_bitrate(bitrate):
+    """Bits per second of an ffmpeg bitrate such as 3M or 128k"""
+    multipliers = {"k": 1e3, "K": 1e3, "M": 1e6, "G": 1e9}
+    try:
+        if bitrate[-1] in multipliers:
+            return float(bitrate[:-1]) * multipliers[bitrate[-1]]
+        return float(bitrate)
+    except (IndexError, TypeError, ValueError):
+        return 0.0
+
+def audio_args(profile):
+    return ["-c:a", "libvorbis", "-b:a", profile.audio_bitrate]
+
+def profile_from_section(name, section):
+    """Build a profile from a presets.ini section. Returns None if the
+    section cannot be parsed
+    """
+    def get_int(key):
+        value = section.get(key)
+        return int(value) if value not in (None, "") else None
+
+    try:
+        return EncoderProfile(
+            name, section["codec"], section.get("deadline") or None,
+            get_int("cpu_used"), section.get("bitrate") or None,
+            get_int("crf"), section.get("row_mt", "0") in ("1", "true"),
+            get_int("tile_columns"), section.get("audio_bitrate", "128k"))
+    except (KeyError, ValueError):
+        LOG.warning("Invalid encoder profile: %s", name)
+        return None
+
+def profile_to_section(profile):
+    section = {"codec": profile.codec}
+    for key in ("deadline", "cpu_used", "bitrate", "crf", "tile_columns",
+                "audio_bitrate"):
+        value = getattr(profile, key)
+        if value is not None:
+            section[key] = str(value)
+    section["row_mt"] = "1" if profile.row_mt else "0"
+    return section
@@ -1,12 +1,17 @@
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import json
 import logging
+import os
 import os.path
-import sys
+import threading
 import time
 
 from PyQt5.QtCore import pyqtSignal, pyqtSlot, QObject
-import requests
 
-from message import GfycatUploaderError, InfoMessage, Message
+from message import GfycatUploaderError, Message, UploadFinishedMessage
+from metrics import METRICS
+from statuswatcher import StatusWatcher
+from utils import app_dir
 
 LOG = logging.getLogger("GfycatUploader")
 
@@ -16,24 +21,83 @@ class GfycatUploader(QObject):
     status_endpoint = "https://api.gfycat.com/v1/gfycats/fetch/status"
     token_endpoint = "https://api.gfycat.com/v1/oauth/token"
 
+    # Refresh this many seconds before the token actually expires
+    token_refresh_margin = 60
+    # Seconds to wait for a status response, so that a hung request only
+    # costs one poll
+    status_timeout = 10
+
     status_sig = pyqtSignal(Message)
 
-    def __init__(self):
+    def __init__(self, max_uploads=4, token_file=None, status_deadline=900.0):
         super().__init__()
-        cwd = os.path.realpath(os.path.dirname(sys.argv[0]))
-        with open(os.path.join(cwd, "apikey.txt"), "r") as api_file:
-            lines = api_file.readlines()
-            self.client_id = lines[0].split("=")[-1].strip()
-            self.client_secret = lines[1].split("=")[-1].strip()
-            self.username = lines[2].split("=")[-1].strip()
-            self.password = lines[3].split("=")[-1].strip()
-
-    def emit_error(self, error_message, status_code=None):
-        error = GfycatUploaderError(error_message, status_code)
+        self.max_uploads = max_uploads
+        self.token_file = token_file
+        self.watcher = StatusWatcher(self.get_upload_status,
+                                     deadline=status_deadline)
+        self._session = None
+        self._token = None
+        self._token_expiry = 0.0
+        self._token_lock = threading.Lock()
+        self.client_id = None
+        self.client_secret = None
+        self.username = None
+        self.password = None
+
+    def load_credentials(self):
+        """Read apikey.txt on first upload rather than at start-up"""
+        if self.client_id is not None:
+            return True
+        try:
+            with open(os.path.join(app_dir(), "apikey.txt"), "r") as api_file:
+                lines = api_file.readlines()
+                self.client_id = lines[0].split("=")[-1].strip()
+                self.client_secret = lines[1].split("=")[-1].strip()
+                self.username = lines[2].split("=")[-1].strip()
+                self.password = lines[3].split("=")[-1].strip()
+        except (OSError, IndexError):
+            self.client_id = None
+            self.emit_error("Unable to read apikey.txt")
+            return False
+        return True
+
+    def emit_error(self, error_message, status_code=None, file_name=None):
+        error = GfycatUploaderError(error_message, status_code, file_name)
         LOG.warning(error)
         self.status_sig.emit(error)
 
-    def get_auth_headers(self):
+    def get_session(self):
+        """Shared HTTP session so that uploads reuse pooled connections
+        instead of opening a new TCP/TLS connection per request
+        """
+        if self._session is None:
+            # Deferred so that start-up does not pay for loading requests
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4,
+                                  pool_maxsize=self.max_uploads)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    def get_auth_headers(self, stale_token=None):
+        """Return headers with a cached access token, requesting a new one
+        when there is none, it is about to expire or it is stale_token,
+        i.e. it was just rejected
+        """
+        with self._token_lock:
+            if self._token is None:
+                self._load_token()
+            if (self._token is None or self._token == stale_token or
+                    time.time() >= (self._token_expiry -
+                                    self.token_refresh_margin)):
+                if not self._request_token():
+                    return None
+            return {"Authorization": "Bearer {}".format(self._token)}
+
+    def _request_token(self):
         body = {
             "grant_type": "password",
             "client_id": self.client_id,
@@ -42,71 +106,173 @@ class GfycatUploader(QObject):
             "password": self.password
         }
 
-        r = requests.post(self.token_endpoint, json=body, timeout=3)
+        r = self.get_session().post(self.token_endpoint, json=body,
+                                    timeout=3)
         if r.status_code != 200:
             self.emit_error("Error requesting token", r.status_code)
-            return None
-        auth_headers = {
-            "Authorization" : "Bearer {}".format(r.json()["access_token"])
+            self._token = None
+            return False
+        res = r.json()
+        self._token = res["access_token"]
+        self._token_expiry = time.time() + float(res.get("expires_in", 3600))
+        self._save_token()
+        return True
+
+    def _load_token(self):
+        if self.token_file is None:
+            return
+        try:
+            with open(self.token_file, "r") as token_file:
+                cached = json.load(token_file)
+            if (cached["client_id"] == self.client_id and
+                    cached["username"] == self.username):
+                self._token = cached["access_token"]
+                self._token_expiry = float(cached["expires_at"])
+        except (OSError, KeyError, TypeError, ValueError):
+            return
+
+    def _save_token(self):
+        if self.token_file is None:
+            return
+        cached = {
+            "client_id": self.client_id,
+            "username": self.username,
+            "access_token": self._token,
+            "expires_at": self._token_expiry
         }
-        return auth_headers
+        try:
+            # Only the owner may read the token
+            fd = os.open(self.token_file,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as token_file:
+                json.dump(cached, token_file)
+        except OSError:
+            LOG.warning("Unable to cache token in %s", self.token_file)
+
+    def post_with_auth(self, url, **kwargs):
+        """POST with the cached token, refreshing it and retrying exactly
+        once if the API rejects it
+        """
+        headers = self.get_auth_headers()
+        if headers is None:
+            return None
+        r = self.get_session().post(url, headers=headers, **kwargs)
+        if r.status_code == 401:
+            LOG.info("Access token rejected, refreshing")
+            stale_token = headers["Authorization"].split(" ", 1)[1]
+            headers = self.get_auth_headers(stale_token)
+            if headers is None:
+                return None
+            r = self.get_session().post(url, headers=headers, **kwargs)
+        return r
 
     @pyqtSlot(list)
     def upload_from_file(self, file_names):
         """Upload a local file to Gfycat. Taken from:
         https://gist.github.com/hellopatrick/ab6a9dfbbc7c1db7e6b817d06399fffd
         """
-        headers = self.get_auth_headers()
-        if headers is None:
+        # Fail early if no token can be had at all
+        try:
+            is_ready = (self.load_credentials() and
+                        self.get_auth_headers() is not None)
+        except (KeyError, OSError, ValueError) as error:
+            # requests' exceptions derive from OSError
+            self.emit_error("Error requesting token: {}".format(error))
+            is_ready = False
+        if not is_ready:
+            # Report every file so that each one can be uploaded again
+            for file_name in file_names:
+                self.emit_error("{} - Not uploaded".format(
+                    os.path.basename(file_name)), file_name=file_name)
             return
-        for file_name in file_names:
-            base_name = os.path.basename(file_name)
-            gif_info = {
-                "title": os.path.splitext(base_name)[0],
-                "noMd5": "true",
-                "nsfw": 1
-            }
-            r = requests.post(self.api_endpoint, json=gif_info,
-                              headers=headers)
+        # Every file is an independent task, a failure only affects its own
+        # file. Finished uploads are handed to the watcher right away, which
+        # polls all pending gfynames from one loop and reports each file as
+        # it completes, so this slot is free for the next batch
+        with ThreadPoolExecutor(max_workers=self.max_uploads) as executor:
+            futures = {executor.submit(self._upload_task, file_name):
+                       file_name for file_name in file_names}
+            for future in as_completed(futures):
+                gfyname = future.result()
+                if gfyname is None:
+                    continue
+                watch = self.watcher.watch(gfyname)
+                watch.add_done_callback(
+                    lambda watch, file_name=futures[future], gfyname=gfyname:
+                    self._check_status(file_name, gfyname, watch.result()))
+
+    def _upload_task(self, file_name):
+        """Request an ID and upload the file. Returns the gfyname, or None
+        if the upload failed
+        """
+        with METRICS.stage("upload", file_name) as stage:
+            try:
+                gfyname = self._upload_file(file_name, stage)
+            except (OSError, ValueError) as error:
+                # requests' exceptions derive from OSError
+                self.emit_error("{} - {}".format(
+                    os.path.basename(file_name), error), file_name=file_name)
+                gfyname = None
+            except KeyError as error:
+                # A response without the gfyname or access_token, which
+                # must not take the other files of the batch down
+                self.emit_error("{} - Unexpected response, no {}".format(
+                    os.path.basename(file_name), error), file_name=file_name)
+                gfyname = None
+            stage.success = gfyname is not None
+        return gfyname
+
+    def _upload_file(self, file_name, stage):
+        session = self.get_session()
+        base_name = os.path.basename(file_name)
+        gif_info = {
+            "title": os.path.splitext(base_name)[0],
+            "noMd5": "true",
+            "nsfw": 1
+        }
+        r = self.post_with_auth(self.api_endpoint, json=gif_info)
+        if r is None:
+            self.emit_error("{} - Not authorized".format(base_name),
+                            file_name=file_name)
+            return None
+        if r.status_code != 200:
+            self.emit_error("{} - Error requesting ID".format(base_name),
+                            r.status_code, file_name)
+            return None
+        gfyname = r.json()["gfyname"]
+        LOG.info("Requested ID: %s", gfyname)
+        with open(file_name, "rb") as source:
+            r = session.put("{}/{}".format(self.filedrop_endpoint, gfyname),
+                            source)
             if r.status_code != 200:
-                self.emit_error("{} - Error requesting ID".format(base_name),
-                                r.status_code)
-                return
-            gfyname = r.json()["gfyname"]
-            LOG.info("Requested ID: %s", gfyname)
-            with open(file_name, "rb") as source:
-                r = requests.put("{}/{}".format(self.filedrop_endpoint,
-                                                gfyname), source)
-                if r.status_code != 200:
-                    self.emit_error("{} - Error uploading file".format(
-                        base_name), r.status_code)
-                    return
-            LOG.info("Encoding %s", base_name)
-            status = "encoding"
-            wait_count = 0
-            while status == "encoding":
-                status = self.get_upload_status(gfyname)
-                time.sleep(3)
-                wait_count += 1
-                if wait_count > 300:
-                    break
-            if status != "complete":
-                self.emit_error("{} - Gfycat could not be created".format(
-                    base_name))
-            else:
-                self.status_sig.emit(InfoMessage(
-                    "Uploaded to https://gfycat.com/{}".format(gfyname)))
+                self.emit_error("{} - Error uploading file".format(base_name),
+                                r.status_code, file_name)
+                return None
+        stage.bytes_read += os.path.getsize(file_name)
+        LOG.info("Encoding %s", base_name)
+        return gfyname
+
+    def _check_status(self, file_name, gfyname, status):
+        if status != "complete":
+            self.emit_error("{} - Gfycat could not be created ({})".format(
+                os.path.basename(file_name), status), file_name=file_name)
+            return
+        self.status_sig.emit(UploadFinishedMessage(
+            file_name, "https://gfycat.com/{}".format(gfyname)))
 
     def get_upload_status(self, gfyname):
         """Get information about an uploaded GIF. Taken from:
         https://github.com/gfycat/api_clients/blob/master/oauth/url_uploader/python/url_uploader.py
         """
-        r = requests.get("{}/{}".format(self.status_endpoint, gfyname))
+        r = self.get_session().get("{}/{}".format(self.status_endpoint,
+                                                  gfyname),
+                                   timeout=self.status_timeout)
+        # Errors are retried by the watcher, so only log them
         if r.status_code != 200:
-            self.emit_error("Unable to check the status", r.status_code)
+            LOG.warning("(%d) Unable to check the status", r.status_code)
             return None
         res = r.json()
         if "task" not in res:
-            self.emit_error("Gfycat API not available")
+            LOG.warning("Gfycat API not available")
             return None
         return res["task"]
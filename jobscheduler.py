@@ -0,0 +1,622 @@
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import subprocess
+import threading
+import time
+
+from batchjournal import BatchJournal
+from clipsmaker import (has_audio_stream, probe_source, RENDER_COPY,
+                        RENDER_FILTERGRAPH, RENDER_SEGMENTS)
+from encoderprofile import (audio_args, BUILTIN_PROFILES, codec_args,
+                            DEFAULT_PROFILE, parse_bitrate)
+from metrics import METRICS
+from message import (ErrorMessage, InfoMessage, JobCancelledMessage,
+                     JobFailedMessage, JobFinishedMessage, ProgressMessage)
+
+LOG = logging.getLogger("JobScheduler")
+
+# Segments are not rate controlled exactly, leave some headroom
+SCRATCH_MARGIN = 1.5
+
+def default_max_workers():
+    # libvpx segment encodes are effectively single-threaded, so one
+    # process per core keeps the machine busy without oversubscribing it
+    return os.cpu_count() or 1
+
+def parse_progress_value(value, suffix=""):
+    try:
+        return float(value.rstrip(suffix))
+    except (AttributeError, ValueError):
+        return 0.0
+
+def progress_out_time(block):
+    # out_time_ms is in microseconds despite its name
+    return parse_progress_value(
+        block.get("out_time_us", block.get("out_time_ms"))) / 1e6
+
+def run_ffmpeg(cmd, stage, on_progress=None, on_start=None):
+    """Run an ffmpeg command line and account it to a metrics stage. With
+    on_progress, ffmpeg reports its progress as key=value blocks on
+    stdout and every completed block is passed to on_progress as a dict.
+    on_start is passed the process as soon as it is running
+    """
+    if on_progress is None:
+        process = subprocess.Popen(cmd)
+        if on_start is not None:
+            on_start(process)
+        return stage.wait(process)
+    cmd = cmd[:1] + ["-progress", "pipe:1", "-nostats"] + cmd[1:]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    if on_start is not None:
+        on_start(process)
+    block = {}
+    with process.stdout:
+        for line in process.stdout:
+            key, sep, value = line.strip().partition("=")
+            if not sep:
+                continue
+            block[key] = value
+            # "progress" is always the last key of a block
+            if key == "progress":
+                on_progress(block)
+                block = {}
+    return stage.wait(process)
+
+def kill_process(process):
+    if process.returncode is None:
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+def terminate_process(process, kill_timeout):
+    """Ask process to stop and kill it if it is still running after
+    kill_timeout seconds. Does not wait for it, the thread that started
+    the process reaps it
+    """
+    try:
+        process.terminate()
+    except OSError:
+        return
+    timer = threading.Timer(kill_timeout, kill_process, [process])
+    timer.daemon = True
+    timer.start()
+
+class ProgressTracker(object):
+    """Aggregates ffmpeg progress of every process working on a job into
+    ProgressMessage, emitted at most once per interval
+    """
+    def __init__(self, job, emit, interval=0.5):
+        self.job = job
+        self.emit = emit
+        self.interval = interval
+        self.total = len(job.start_times) * job.duration
+        self.out_times = {}
+        self.t_start = time.monotonic()
+        self.t_last_emit = 0.0
+        self._lock = threading.Lock()
+
+    def skip(self, slot):
+        """Count a clip that needed no processing as done"""
+        with self._lock:
+            self.out_times[slot] = self.job.duration
+
+    def update(self, slot, clip_index, block):
+        out_time = progress_out_time(block)
+        with self._lock:
+            self.out_times[slot] = max(out_time, 0.0)
+            now = time.monotonic()
+            if (block.get("progress") != "end" and
+                    now - self.t_last_emit < self.interval):
+                return
+            self.t_last_emit = now
+            done = min(sum(self.out_times.values()), self.total)
+        fraction = done / self.total if self.total else 1.0
+        elapsed = now - self.t_start
+        eta = elapsed / fraction - elapsed if fraction else 0.0
+        self.emit(ProgressMessage(
+            self.job.source, clip_index, out_time,
+            parse_progress_value(block.get("fps")),
+            parse_progress_value(block.get("speed"), "x"), 100 * fraction,
+            eta))
+
+def build_filter_graph(offsets, duration, has_audio):
+    """Build a filter graph that cuts every clip out of input 0 with
+    trim/atrim and joins them with a single concat filter. offsets are
+    relative to the input seek point
+    """
+    num_clip = len(offsets)
+    filters = ["[0:v]split={}{}".format(
+        num_clip, "".join("[v{}]".format(j) for j in range(num_clip)))]
+    if has_audio:
+        filters.append("[0:a]asplit={}{}".format(
+            num_clip, "".join("[a{}]".format(j) for j in range(num_clip))))
+    concat_inputs = ""
+    for j, offset in enumerate(offsets):
+        filters.append(
+            "[v{0}]trim=start={1:.3f}:duration={2},"
+            "setpts=PTS-STARTPTS[cv{0}]".format(j, offset, duration))
+        concat_inputs += "[cv{}]".format(j)
+        if has_audio:
+            filters.append(
+                "[a{0}]atrim=start={1:.3f}:duration={2},"
+                "asetpts=PTS-STARTPTS[ca{0}]".format(j, offset, duration))
+            concat_inputs += "[ca{}]".format(j)
+    if has_audio:
+        filters.append("{}concat=n={}:v=1:a=1[v][a]".format(concat_inputs,
+                                                            num_clip))
+    else:
+        filters.append("{}concat=n={}:v=1:a=0[v]".format(concat_inputs,
+                                                         num_clip))
+    return ";".join(filters)
+
+def job_profile(job):
+    return job.profile or BUILTIN_PROFILES[DEFAULT_PROFILE]
+
+def estimate_scratch_bytes(job):
+    """Upper estimate of the space the segments of job take up, based on
+    the bitrate of the source and of the encoder profile
+    """
+    info = probe_source(job.source)
+    try:
+        source_bps = os.path.getsize(job.source) * 8 / info["duration"]
+    except (OSError, TypeError, ZeroDivisionError):
+        source_bps = 0.0
+    if job.render_mode == RENDER_COPY:
+        bps = source_bps
+    else:
+        profile = job_profile(job)
+        bps = (max(source_bps, parse_bitrate(profile.bitrate)) +
+               parse_bitrate(profile.audio_bitrate))
+    return int(len(job.start_times) * job.duration * bps / 8 *
+               SCRATCH_MARGIN)
+
+def jobs_from_options(args):
+    """Split a ClipsMaker.get_options() dict into one EncodeJob per
+    source
+    """
+    jobs = []
+    for i, source in enumerate(args["source"]):
+        if args.get("start_times"):
+            start_times = args["start_times"][i]
+        else:
+            jump = args["jump"][i]
+            start_times = [args["start_time"] + j * jump
+                           for j in range(args["num_clip"])]
+        jobs.append(EncodeJob(source, args["target"][i], start_times,
+                              args["duration"],
+                              args.get("render_mode", RENDER_SEGMENTS),
+                              args.get("profile")))
+    return jobs
+
+class JobScheduler(object):
+    """Runs every EncodeJob as an independent unit of work. Clip and
+    filter graph encodes from all jobs share a single pool of max_workers
+    processes, while up to max_sources jobs are in flight at once so that
+    one source can be concatenated while the next one is still encoding.
+
+    Segments are written next to the source unless scratch_dir, e.g. a
+    tmpfs such as /dev/shm, has room for them. At most scratch_max_bytes
+    of it are in use at once; jobs that do not fit fall back to disk.
+
+    cancel() may be called from any thread to stop one job or the whole
+    batch while run() is in progress.
+
+    With journal_dir, every batch keeps a BatchJournal there until it has
+    run to the end, and resume() picks up a batch that did not.
+    """
+    def __init__(self, max_workers=None, max_sources=None,
+                 status_callback=None, segment_cache=None,
+                 progress_interval=0.5, scratch_dir=None,
+                 scratch_max_bytes=1024 ** 3, kill_timeout=3.0,
+                 journal_dir=None):
+        self.max_workers = max_workers or default_max_workers()
+        self.max_sources = max_sources or min(self.max_workers, 4)
+        self.status_callback = status_callback
+        self.segment_cache = segment_cache
+        self.progress_interval = progress_interval
+        self.scratch_dir = scratch_dir
+        self.scratch_max_bytes = scratch_max_bytes
+        self._scratch_reserved = 0
+        self._scratch_lock = threading.Lock()
+        self.kill_timeout = kill_timeout
+        self._cancel_all = False
+        self._cancelled = set()
+        # Running ffmpeg processes by job source
+        self._processes = defaultdict(set)
+        self._cancel_lock = threading.Lock()
+        self.journal_dir = journal_dir
+        self._journal = None
+        # Jobs of the current batch that can be in flight at once
+        self._num_parallel_jobs = 1
+
+    def cancel(self, source=None):
+        """Cancel the job of source, or every job if source is None.
+        Running ffmpeg processes are terminated right away, queued ones
+        never start
+        """
+        with self._cancel_lock:
+            if source is None:
+                self._cancel_all = True
+                processes = [process for job_processes
+                             in self._processes.values()
+                             for process in job_processes]
+            else:
+                self._cancelled.add(source)
+                processes = list(self._processes[source])
+        for process in processes:
+            terminate_process(process, self.kill_timeout)
+
+    def is_cancelled(self, source):
+        with self._cancel_lock:
+            return self._cancel_all or source in self._cancelled
+
+    def emit(self, message):
+        if self.status_callback is not None:
+            self.status_callback(message)
+
+    def resume(self, journal_file):
+        """Run the unfinished part of a journaled batch"""
+        journal = BatchJournal.load(journal_file)
+        if journal is None:
+            self.emit(ErrorMessage("Unable to resume {}".format(
+                os.path.basename(journal_file))))
+            return []
+        if not journal.lock():
+            self.emit(ErrorMessage("{} - Batch is already running".format(
+                os.path.basename(journal_file))))
+            return []
+        self.emit(InfoMessage("Resuming batch of {} sources".format(
+            len(journal.jobs))))
+        return self.run([EncodeJob(*job) for job in journal.get_jobs()],
+                        journal)
+
+    def run(self, jobs, journal=None):
+        """Encode every job and return a list of (job, success) in job
+        order. jobs may be a get_options() dict or a list of EncodeJob
+        """
+        if isinstance(jobs, dict):
+            jobs = jobs_from_options(jobs)
+        if journal is None and self.journal_dir is not None:
+            journal = BatchJournal.create(self.journal_dir, jobs)
+        self._journal = journal
+        with self._cancel_lock:
+            self._cancel_all = False
+            self._cancelled.clear()
+            self._processes.clear()
+        self._num_parallel_jobs = max(1, min(self.max_sources, len(jobs)))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as clip_pool, \
+                ThreadPoolExecutor(max_workers=self.max_sources) as job_pool:
+            futures = [job_pool.submit(self.run_job, job, clip_pool)
+                       for job in jobs]
+            results = [(job, future.result())
+                       for job, future in zip(jobs, futures)]
+        # Only evict once no job is reading from the cache any more
+        if self.segment_cache is not None:
+            self.segment_cache.evict()
+        # The batch ran to the end, nothing is left to resume. A batch
+        # that was cancelled as a whole, e.g. on quit or SIGTERM, or an
+        # exception leaves the journal in place
+        if journal is not None:
+            with self._cancel_lock:
+                cancelled_all = self._cancel_all
+            if cancelled_all:
+                journal.close()
+            else:
+                journal.discard()
+        self._journal = None
+        return results
+
+    def run_job(self, job, clip_pool):
+        if self.is_cancelled(job.source):
+            self.emit(JobCancelledMessage(job.source))
+            return False
+        if self._journal is not None and self._journal.has_trailer(job):
+            self.emit(InfoMessage("{} - Already finished".format(
+                os.path.basename(job.source))))
+            self.emit(JobFinishedMessage(job.source, job.target))
+            return True
+        try:
+            success = self._encode(job, clip_pool)
+        except OSError as error:
+            if not self.is_cancelled(job.source):
+                LOG.exception("Failed to encode %s", job.source)
+                self.emit(JobFailedMessage(job.source, str(error)))
+                return False
+            success = False
+        if not success and self.is_cancelled(job.source):
+            # Do not leave a truncated trailer behind
+            try:
+                os.remove(job.target)
+            except OSError:
+                pass
+            self.emit(JobCancelledMessage(job.source))
+            return False
+        if success:
+            if self._journal is not None:
+                self._journal.add_trailer(job)
+            self.emit(JobFinishedMessage(job.source, job.target))
+        return success
+
+    def _encode(self, job, clip_pool):
+        self.emit(InfoMessage("Converting {}".format(job.source)))
+        tracker = ProgressTracker(job, self.emit, self.progress_interval)
+        if job.render_mode == RENDER_FILTERGRAPH:
+            # Takes a slot of the shared pool like any segment encode
+            return clip_pool.submit(self._encode_filter_graph, job,
+                                    tracker).result()
+        return self._encode_segments(job, clip_pool, tracker)
+
+    def _encode_filter_graph(self, job, tracker):
+        # Seek once to the first clip and stop reading after the last one;
+        # everything in between is decoded by the one process
+        first_start = job.start_times[0]
+        read_duration = job.start_times[-1] + job.duration - first_start
+        offsets = [start_time - first_start for start_time in job.start_times]
+        has_audio = has_audio_stream(job.source)
+        profile = job_profile(job)
+        # The only encoder of this job, so let it use its share of the
+        # cores the batch may use
+        threads = max(1, self.max_workers // self._num_parallel_jobs)
+        cmd = (["ffmpeg", "-hide_banner", "-ss", str(first_start), "-t",
+                str(read_duration), "-i", job.source, "-filter_complex",
+                build_filter_graph(offsets, job.duration, has_audio),
+                "-map", "[v]"] +
+               codec_args(profile, threads))
+        if has_audio:
+            cmd.extend(["-map", "[a]"] + audio_args(profile))
+        cmd.extend(["-y", job.target])
+        LOG.debug(" ".join(cmd))
+
+        def on_progress(block):
+            clip_index = min(int(progress_out_time(block) // job.duration),
+                             len(offsets) - 1)
+            tracker.update(0, clip_index, block)
+
+        with METRICS.stage("encode", job.source) as stage:
+            rc = self._run_ffmpeg(job.source, cmd, stage, on_progress)
+        if rc:
+            if not self.is_cancelled(job.source):
+                self.emit(JobFailedMessage(
+                    job.source, "Encoding failed (exit code {})".format(rc)))
+            return False
+        return True
+
+    def _reserve_scratch(self, job):
+        """Pick the scratch directory of job. Returns the scratch root, the
+        job's own directory in it and the bytes reserved in scratch_dir,
+        None if the segments go to disk next to the source
+        """
+        base_name = os.path.basename(job.source)
+        if self.scratch_dir is not None:
+            needed = estimate_scratch_bytes(job)
+            with self._scratch_lock:
+                try:
+                    free = shutil.disk_usage(self.scratch_dir).free
+                except OSError:
+                    free = 0
+                if (needed <= free - self._scratch_reserved and
+                        needed <= (self.scratch_max_bytes -
+                                   self._scratch_reserved)):
+                    self._scratch_reserved += needed
+                    tmp_root = os.path.join(
+                        self.scratch_dir, "clips-{}".format(os.getpid()))
+                    # Sources from different folders may share a name
+                    digest = hashlib.sha1(os.path.abspath(
+                        job.source).encode("utf-8")).hexdigest()[:8]
+                    return (tmp_root, os.path.join(tmp_root, "{}-{}".format(
+                        base_name, digest)), needed)
+            self.emit(InfoMessage(
+                "{} - Not enough scratch space ({} MiB needed), using "
+                "disk".format(base_name, needed // 1024 ** 2)))
+        # Each job gets its own scratch directory so sources sharing a
+        # folder can be encoded side by side
+        tmp_root = os.path.normpath(os.path.join(
+            os.path.dirname(job.source), "tmp"))
+        return tmp_root, os.path.join(tmp_root, base_name), None
+
+    def _encode_segments(self, job, clip_pool, tracker):
+        tmp_root, tmp_dir, reserved = self._reserve_scratch(job)
+        try:
+            return self._encode_segments_in(job, clip_pool, tracker,
+                                            tmp_root, tmp_dir)
+        finally:
+            # Failed jobs must not keep holding memory either, and
+            # cancelled ones leave nothing behind
+            if reserved is not None or self.is_cancelled(job.source):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                try:
+                    os.rmdir(tmp_root)
+                except OSError:
+                    pass
+            if reserved is not None:
+                with self._scratch_lock:
+                    self._scratch_reserved -= reserved
+
+    def _encode_segments_in(self, job, clip_pool, tracker, tmp_root,
+                            tmp_dir):
+        base_name = os.path.basename(job.source)
+        prefix, __ = os.path.splitext(base_name)
+        clip_file = os.path.join(tmp_dir, "cliplist.txt")
+        debug_file = os.path.join(tmp_dir, "debug.txt")
+
+        if not os.path.exists(tmp_dir):
+            os.makedirs(tmp_dir)
+
+        if job.render_mode == RENDER_COPY:
+            # Start times are keyframe aligned, so packets can be copied
+            encoder_args = ["-c", "copy"]
+            thread_args = []
+            extension = ".mkv"
+        else:
+            profile = job_profile(job)
+            encoder_args = codec_args(profile) + audio_args(profile)
+            # Segments already run one process per core; only spread the
+            # spare cores when the clips of every job in flight are fewer
+            # than the workers
+            thread_args = ["-threads", str(max(
+                1, self.max_workers // (len(job.start_times) *
+                                        self._num_parallel_jobs)))]
+            extension = ".webm"
+        segments = []
+        for j, start_time in enumerate(job.start_times):
+            file_name = os.path.join(tmp_dir, "{}_{}{}".format(prefix, j,
+                                                               extension))
+            cmd = (["ffmpeg", "-fflags", "+genpts", "-hide_banner", "-ss",
+                    "{:.3f}".format(start_time), "-i", job.source, "-t",
+                    str(job.duration)] + encoder_args + thread_args +
+                   ["-avoid_negative_ts", "1", "-y", file_name])
+            key = None
+            if self.segment_cache is not None:
+                key = self.segment_cache.key(job.source, start_time,
+                                             job.duration, encoder_args)
+            segments.append(Segment(j, job.source, cmd, file_name, key,
+                                    extension, start_time, job.duration))
+        # map() yields in submission order, so the clip list stays
+        # deterministic regardless of which encode finishes first
+        results = list(clip_pool.map(
+            lambda segment: self._encode_segment(segment, tracker),
+            segments))
+        if self.is_cancelled(job.source):
+            return False
+
+        failed = [j for j, (rc, __, __) in enumerate(results) if rc]
+        if failed:
+            self._store_segments(segments, results)
+        for j in failed:
+            self.emit(ErrorMessage(
+                "{} - Clip {} failed (exit code {})".format(
+                    base_name, j, results[j][0])))
+        if failed:
+            self.emit(JobFailedMessage(job.source, "Encoding failed"))
+            return False
+        num_cached = sum(1 for __, __, is_reused in results if is_reused)
+        if num_cached:
+            self.emit(InfoMessage("{} - Reused {} of {} segments".format(
+                base_name, num_cached, len(results))))
+
+        cmd = ["ffmpeg", "-fflags", "+genpts", "-hide_banner", "-f",
+               "concat", "-safe", "0", "-i", clip_file, "-c:v", "copy",
+               "-c:a", "copy", "-threads", "2", "-y", job.target]
+        with open(debug_file, "w") as debug, open(clip_file, "w") as outfile:
+            for segment, (__, file_name, __) in zip(segments, results):
+                outfile.write("file '{}'\n".format(file_name))
+                debug.write("{}\n".format(" ".join(segment.cmd)))
+            debug.write("{}\n".format(" ".join(cmd)))
+        with METRICS.stage("concat", job.source) as stage:
+            rc = self._run_ffmpeg(job.source, cmd, stage)
+        if not self.is_cancelled(job.source):
+            self._store_segments(segments, results)
+        if rc:
+            if not self.is_cancelled(job.source):
+                self.emit(JobFailedMessage(
+                    job.source, "Concat failed (exit code {})".format(rc)))
+            return False
+
+        shutil.rmtree(tmp_dir)
+        self._remove_resumed(results, tmp_dir)
+        try:
+            os.rmdir(tmp_root)
+        except OSError:
+            # Another job is still using the scratch root
+            pass
+        return True
+
+    def _remove_resumed(self, results, tmp_dir):
+        """Delete segments reused from an earlier run once they are part of
+        the trailer, unless they belong to the segment cache
+        """
+        for __, file_name, is_reused in results:
+            if (not is_reused or
+                    os.path.dirname(file_name) == tmp_dir or
+                    (self.segment_cache is not None and file_name.startswith(
+                        self.segment_cache.cache_dir))):
+                continue
+            try:
+                os.remove(file_name)
+                os.rmdir(os.path.dirname(file_name))
+            except OSError:
+                pass
+
+    def _encode_segment(self, segment, tracker):
+        """Encode a single segment unless the journal or the cache already
+        holds it. Returns the exit code, the file to concat and whether it
+        was reused
+        """
+        if self.is_cancelled(segment.source):
+            return -1, segment.file_name, False
+        if self._journal is not None:
+            file_name = self._journal.find_segment(
+                segment.source, segment.index, segment.start_time,
+                segment.duration)
+            if file_name is not None:
+                tracker.skip(segment.index)
+                return 0, file_name, True
+        if segment.key is not None:
+            cached = self.segment_cache.lookup(segment.key, segment.extension)
+            if cached is not None:
+                tracker.skip(segment.index)
+                return 0, cached, True
+        with METRICS.stage("encode", segment.source) as stage:
+            rc = self._run_ffmpeg(
+                segment.source, segment.cmd, stage,
+                lambda block: tracker.update(segment.index, segment.index,
+                                             block))
+        if rc:
+            return rc, segment.file_name, False
+        if self._journal is not None:
+            self._journal.add_segment(segment.source, segment.index,
+                                      segment.start_time, segment.duration,
+                                      segment.file_name)
+        return 0, segment.file_name, False
+
+    def _store_segments(self, segments, results):
+        """Move the freshly encoded segments into the segment cache. Done
+        only after the concat step, so that it reads them from the
+        scratch directory rather than from the cache on disk
+        """
+        if self.segment_cache is None:
+            return
+        for segment, (rc, file_name, is_reused) in zip(segments, results):
+            if rc or is_reused or segment.key is None:
+                continue
+            try:
+                self.segment_cache.store(segment.key, segment.extension,
+                                         file_name)
+            except OSError:
+                LOG.warning("Unable to cache %s", file_name)
+
+    def _run_ffmpeg(self, source, cmd, stage, on_progress=None):
+        """run_ffmpeg, keeping track of the process so that cancel() can
+        terminate it
+        """
+        processes = []
+
+        def on_start(process):
+            processes.append(process)
+            with self._cancel_lock:
+                self._processes[source].add(process)
+                # cancel() may have run between the last check and now
+                cancelled = self._cancel_all or source in self._cancelled
+            if cancelled:
+                terminate_process(process, self.kill_timeout)
+
+        try:
+            return run_ffmpeg(cmd, stage, on_progress, on_start)
+        finally:
+            with self._cancel_lock:
+                for process in processes:
+                    self._processes[source].discard(process)
+
+EncodeJob = namedtuple("EncodeJob", ["source", "target", "start_times",
+                                     "duration", "render_mode", "profile"])
+EncodeJob.__new__.__defaults__ = (RENDER_SEGMENTS, None)
+Segment = namedtuple("Segment", ["index", "source", "cmd", "file_name",
+                                 "key", "extension", "start_time",
+                                 "duration"])
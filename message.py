@@ -1,3 +1,5 @@
+import os.path
+
 class Message(object):
     def __init__(self, message_type, message):
         self._message_type = message_type
@@ -19,8 +21,47 @@ class InfoMessage(Message):
         super().__init__("INFO", message)
 
 class GfycatUploaderError(ErrorMessage):
-    def __init__(self, error_message, status_code=None):
+    def __init__(self, error_message, status_code=None, file_name=None):
         if status_code:
             super().__init__("({}) {}".format(status_code, error_message))
         else:
             super().__init__(error_message)
+        self.file_name = file_name
+
+class UploadFinishedMessage(InfoMessage):
+    def __init__(self, file_name, url):
+        super().__init__("Uploaded to {}".format(url))
+        self.file_name = file_name
+        self.url = url
+
+class JobFinishedMessage(InfoMessage):
+    def __init__(self, source, target):
+        super().__init__("Finished {}".format(target))
+        self.source = source
+        self.target = target
+
+class JobFailedMessage(ErrorMessage):
+    def __init__(self, source, error_message):
+        super().__init__("{} - {}".format(os.path.basename(source),
+                                           error_message))
+        self.source = source
+
+class JobCancelledMessage(Message):
+    def __init__(self, source):
+        super().__init__("CANCELLED", os.path.basename(source))
+        self.source = source
+
+class ProgressMessage(Message):
+    def __init__(self, source, clip_index, out_time, fps, speed, percent,
+                 eta):
+        super().__init__("PROGRESS", (
+            "{} - Clip {}: {:.1f}s at {:.1f} fps ({:.2f}x), {:.0f}%, "
+            "ETA {:.0f}s".format(os.path.basename(source), clip_index,
+                                 out_time, fps, speed, percent, eta)))
+        self.source = source
+        self.clip_index = clip_index
+        self.out_time = out_time
+        self.fps = fps
+        self.speed = speed
+        self.percent = percent
+        self.eta = eta
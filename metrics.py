@@ -0,0 +1,190 @@
+"""Per-stage performance metrics (probe, encode, concat, upload). Disabled
+by default; when disabled every stage is a shared no-op object.
+
+    METRICS.configure("metrics.jsonl", "clips.prom")
+    with METRICS.stage("encode", source) as stage:
+        process = subprocess.Popen(cmd)
+        rc = stage.wait(process)
+"""
+from collections import defaultdict
+import json
+import logging
+import logging.handlers
+import os
+import os.path
+import threading
+import time
+
+LOG = logging.getLogger("Metrics")
+
+def read_proc_io(pid):
+    """Return (rchar, wchar) of a process that has exited but not been
+    reaped yet. Linux only
+    """
+    counters = {}
+    try:
+        with open("/proc/{}/io".format(pid), "r") as io_file:
+            for line in io_file:
+                key, __, value = line.partition(":")
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        return 0, 0
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+class NullStage(object):
+    bytes_read = 0
+    bytes_written = 0
+    success = True
+
+    def __setattr__(self, name, value):
+        # Shared by every caller while metrics are disabled
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def wait(self, process):
+        return process.wait()
+
+class Stage(object):
+    def __init__(self, metrics, name, job):
+        self.metrics = metrics
+        self.name = name
+        self.job = job
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.child_cpu_time = 0.0
+        self.exit_codes = []
+        self.success = True
+        self._t_start = None
+        self._cpu_start = None
+
+    def __enter__(self):
+        self._t_start = time.perf_counter()
+        self._cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is not None or any(self.exit_codes):
+            self.success = False
+        self.metrics.record({
+            "time": time.time(),
+            "stage": self.name,
+            "job": self.job,
+            "wall_time": time.perf_counter() - self._t_start,
+            "cpu_time": (time.thread_time() - self._cpu_start +
+                         self.child_cpu_time),
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "exit_codes": self.exit_codes,
+            "success": self.success
+        })
+        return False
+
+    def wait(self, process):
+        """Wait for process and account its CPU time, I/O and exit code to
+        this stage
+        """
+        if not hasattr(os, "wait4"):
+            self.exit_codes.append(process.wait())
+            return process.returncode
+        try:
+            if hasattr(os, "WNOWAIT"):
+                # Leave the child as a zombie so /proc/<pid>/io can be read
+                os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+                bytes_read, bytes_written = read_proc_io(process.pid)
+                self.bytes_read += bytes_read
+                self.bytes_written += bytes_written
+            __, status, rusage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            # Already reaped by Popen, e.g. while being terminated from
+            # another thread
+            self.exit_codes.append(process.wait())
+            return process.returncode
+        process.returncode = os.waitstatus_to_exitcode(status)
+        self.child_cpu_time += rusage.ru_utime + rusage.ru_stime
+        self.exit_codes.append(process.returncode)
+        return process.returncode
+
+class Metrics(object):
+    def __init__(self):
+        self.enabled = False
+        self.prometheus_file = None
+        self._logger = None
+        self._totals = defaultdict(lambda: defaultdict(float))
+        self._lock = threading.Lock()
+
+    def configure(self, file_name=None, prometheus_file=None,
+                  max_bytes=10 * 1024 ** 2, backup_count=5):
+        """Enable collection. Records go to a rotating JSON-lines file and
+        stage totals to a Prometheus text-format file
+        """
+        if file_name is not None:
+            handler = logging.handlers.RotatingFileHandler(
+                file_name, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger = logging.getLogger("Metrics.records")
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            self._logger.addHandler(handler)
+        self.prometheus_file = prometheus_file
+        self.enabled = file_name is not None or prometheus_file is not None
+
+    def configure_from_env(self):
+        self.configure(os.environ.get("CLIPS_METRICS_FILE"),
+                       os.environ.get("CLIPS_METRICS_PROM"))
+
+    def stage(self, name, job=""):
+        if not self.enabled:
+            return _NULL_STAGE
+        return Stage(self, name, job)
+
+    def record(self, record):
+        with self._lock:
+            if self._logger is not None:
+                self._logger.info(json.dumps(record))
+            totals = self._totals[record["stage"]]
+            totals["count"] += 1
+            totals["failures"] += 0 if record["success"] else 1
+            for key in ("wall_time", "cpu_time", "bytes_read",
+                        "bytes_written"):
+                totals[key] += record[key]
+            if self.prometheus_file is not None:
+                self._write_prometheus()
+
+    def _write_prometheus(self):
+        series = [
+            ("clips_stage_runs_total", "count", "counter",
+             "Number of completed stages"),
+            ("clips_stage_failures_total", "failures", "counter",
+             "Number of failed stages"),
+            ("clips_stage_wall_seconds_total", "wall_time", "counter",
+             "Wall time spent in stages"),
+            ("clips_stage_cpu_seconds_total", "cpu_time", "counter",
+             "CPU time spent in stages, including subprocesses"),
+            ("clips_stage_read_bytes_total", "bytes_read", "counter",
+             "Bytes read by stages"),
+            ("clips_stage_written_bytes_total", "bytes_written", "counter",
+             "Bytes written by stages")
+        ]
+        lines = []
+        for metric, key, metric_type, help_str in series:
+            lines.append("# HELP {} {}".format(metric, help_str))
+            lines.append("# TYPE {} {}".format(metric, metric_type))
+            for stage, totals in sorted(self._totals.items()):
+                lines.append('{}{{stage="{}"}} {}'.format(metric, stage,
+                                                          totals[key]))
+        # The node exporter may read at any time, so replace atomically
+        tmp_file = self.prometheus_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as prom_file:
+                prom_file.write("\n".join(lines) + "\n")
+            os.replace(tmp_file, self.prometheus_file)
+        except OSError:
+            LOG.warning("Unable to write %s", self.prometheus_file)
+
+_NULL_STAGE = NullStage()
+METRICS = Metrics()
@@ -0,0 +1,78 @@
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import threading
+
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QObject
+
+from clipsmaker import build_index, check_source
+from clipsmodel import INDEX_WORKERS, PROBE_WORKERS
+
+class ProbeWorker(QObject):
+    """Probes and indexes sources off the GUI thread and reports every
+    file as soon as it is done. Scans are numbered by the caller so that
+    results of a cancelled scan can be told apart
+    """
+    result_sig = pyqtSignal(int, str, bool, str, int)
+    finished_sig = pyqtSignal(int, bool)
+    index_result_sig = pyqtSignal(int, str, list)
+    index_finished_sig = pyqtSignal(int, bool)
+
+    def __init__(self):
+        super().__init__()
+        self._cancelled_scan_id = 0
+        self._lock = threading.Lock()
+
+    def cancel(self, scan_id):
+        """Cancel scan_id and every scan before it. Called directly from
+        the GUI thread, this worker's thread is busy with the scan
+        """
+        with self._lock:
+            self._cancelled_scan_id = max(self._cancelled_scan_id, scan_id)
+
+    def is_cancelled(self, scan_id):
+        with self._lock:
+            return scan_id <= self._cancelled_scan_id
+
+    @pyqtSlot(int, list, list)
+    def index(self, scan_id, file_names, kinds):
+        """Build the kinds of index of file_names, see build_index"""
+        def build(file_name):
+            for kind in kinds:
+                build_index(kind, file_name)
+
+        def report(file_name, result):
+            self.index_result_sig.emit(scan_id, file_name, kinds)
+
+        cancelled = self._run(scan_id, file_names, build, INDEX_WORKERS,
+                              report)
+        self.index_finished_sig.emit(scan_id, cancelled)
+
+    @pyqtSlot(int, list)
+    def probe(self, scan_id, file_names):
+        def report(file_name, result):
+            is_valid, target, length = result
+            self.result_sig.emit(scan_id, file_name, is_valid, target,
+                                 int(length))
+
+        cancelled = self._run(scan_id, file_names, check_source,
+                              PROBE_WORKERS, report)
+        self.finished_sig.emit(scan_id, cancelled)
+
+    def _run(self, scan_id, file_names, function, max_workers, report):
+        """Call function on every file name and report the results in the
+        order they complete. Returns True if the scan was cancelled
+        """
+        if self.is_cancelled(scan_id):
+            # Cancelled while queued behind another scan
+            return True
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {executor.submit(function, file_name): file_name
+                   for file_name in file_names}
+        try:
+            for future in as_completed(futures):
+                if self.is_cancelled(scan_id):
+                    return True
+                report(futures[future], future.result())
+        finally:
+            # Work that is already running finishes in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+        return False
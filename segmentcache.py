@@ -0,0 +1,77 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import threading
+
+from sourcecache import source_fingerprint
+from utils import app_dir
+
+LOG = logging.getLogger("SegmentCache")
+
+class SegmentCache(object):
+    """Content-addressed store of encoded clip segments. A segment is
+    keyed by the source fingerprint, its start time and duration and the
+    encoder arguments, so any change to those produces a new entry. Files
+    are touched on every hit and the least recently used ones are evicted
+    once the directory grows past max_bytes
+    """
+    def __init__(self, cache_dir=None, max_bytes=10 * 1024 ** 3):
+        self.cache_dir = cache_dir or os.path.join(app_dir(), "segments")
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def key(self, source_path, start_time, duration, encoder_args):
+        payload = json.dumps([source_fingerprint(source_path),
+                              "{:.3f}".format(start_time), str(duration),
+                              encoder_args])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key, extension):
+        return os.path.join(self.cache_dir, key[:2], key + extension)
+
+    def lookup(self, key, extension):
+        path = self.path(key, extension)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def store(self, key, extension, file_name):
+        """Move a freshly encoded segment into the cache and return its new
+        location
+        """
+        path = self.path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The scratch directory may live on another file system
+        partial = path + ".partial"
+        shutil.move(file_name, partial)
+        os.replace(partial, path)
+        return path
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for dir_path, __, file_names in os.walk(self.cache_dir):
+                for file_name in file_names:
+                    path = os.path.join(dir_path, file_name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+            entries.sort()
+            for __, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    LOG.info("Evicted %s", path)
+                except OSError:
+                    LOG.warning("Unable to evict %s", path)
@@ -0,0 +1,176 @@
+import atexit
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+
+from utils import app_dir
+
+LOG = logging.getLogger("SourceCache")
+
+def source_fingerprint(source_path):
+    """Identify a source by absolute path, size and modification time so
+    that cached results are dropped as soon as the file changes
+    """
+    stat = os.stat(source_path)
+    return os.path.abspath(source_path), stat.st_size, stat.st_mtime_ns
+
+def sqlite3_module():
+    # Deferred so that start-up does not pay for loading sqlite3
+    import sqlite3
+    return sqlite3
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache():
+    """Shared cache stored next to presets.ini"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = SourceCache(os.path.join(app_dir(),
+                                                      "cache.sqlite"))
+            atexit.register(_default_cache.flush)
+        return _default_cache
+
+class SourceCache(object):
+    """Persistent per-source results (probe info, keyframe index, ...)
+    stored in a SQLite file. Entries are keyed by kind and source
+    fingerprint, and the least recently used ones are evicted once there
+    are more than max_entries. Hits only note their last use in memory,
+    it is written with the next put or flush()
+    """
+    def __init__(self, file_name, max_entries=10000):
+        self.file_name = file_name
+        self.max_entries = max_entries
+        self._connection = None
+        self._is_disabled = False
+        self._lock = threading.Lock()
+        # Last use of the entries hit since the last write, by (kind, path)
+        self._last_used = {}
+
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3_module().connect(self.file_name,
+                                                  check_same_thread=False)
+            try:
+                # Keep commits cheap
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS entries ("
+                    "kind TEXT, path TEXT, size INTEGER, mtime INTEGER, "
+                    "last_used REAL, payload TEXT, PRIMARY KEY (kind, path))")
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS entries_last_used "
+                    "ON entries (last_used)")
+            except sqlite3_module().Error:
+                connection.close()
+                raise
+            self._connection = connection
+        return self._connection
+
+    def _run(self, operation, default=None):
+        """Call operation with the connection while holding the lock. A
+        cache that cannot be opened, read or written acts like an empty
+        one, so that it never breaks probing
+        """
+        with self._lock:
+            if self._is_disabled:
+                return default
+            try:
+                return operation(self._connect())
+            except sqlite3_module().Error as error:
+                if self._connection is None:
+                    # Opening it will not work any better next time
+                    self._is_disabled = True
+                    LOG.warning("Source cache %s disabled: %s",
+                                self.file_name, error)
+                else:
+                    LOG.warning("Source cache %s: %s", self.file_name,
+                                error)
+                return default
+
+    def get(self, kind, source_path):
+        try:
+            path, size, mtime = source_fingerprint(source_path)
+        except OSError:
+            return None
+
+        def select(connection):
+            row = connection.execute(
+                "SELECT size, mtime, payload FROM entries "
+                "WHERE kind = ? AND path = ?", (kind, path)).fetchone()
+            if row is None:
+                return None
+            if row[0] != size or row[1] != mtime:
+                LOG.info("Stale %s entry: %s", kind, path)
+                connection.execute(
+                    "DELETE FROM entries WHERE kind = ? AND path = ?",
+                    (kind, path))
+                connection.commit()
+                return None
+            self._last_used[(kind, path)] = time.time()
+            return row[2]
+
+        payload = self._run(select)
+        return json.loads(payload) if payload is not None else None
+
+    def put(self, kind, source_path, payload):
+        try:
+            path, size, mtime = source_fingerprint(source_path)
+        except OSError:
+            return
+
+        def insert(connection):
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, path, size, mtime, time.time(), json.dumps(payload)))
+            self._write_last_used(connection)
+            self._evict(connection)
+            connection.commit()
+
+        self._run(insert)
+
+    def flush(self):
+        """Write the last use of the entries hit since the last write"""
+        def update(connection):
+            if self._last_used:
+                self._write_last_used(connection)
+                connection.commit()
+
+        self._run(update)
+
+    def invalidate(self, source_path):
+        """Drop every entry of source_path, whatever its kind"""
+        def delete(connection):
+            connection.execute("DELETE FROM entries WHERE path = ?",
+                               (os.path.abspath(source_path),))
+            connection.commit()
+
+        self._run(delete)
+
+    def clear(self):
+        def delete(connection):
+            connection.execute("DELETE FROM entries")
+            connection.commit()
+
+        self._run(delete)
+
+    def _write_last_used(self, connection):
+        connection.executemany(
+            "UPDATE entries SET last_used = ? WHERE kind = ? AND path = ?",
+            [(last_used, kind, path) for (kind, path), last_used
+             in self._last_used.items()])
+        self._last_used.clear()
+
+    def _evict(self, connection):
+        count = connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+        excess = count[0] - self.max_entries
+        if excess > 0:
+            LOG.info("Evicting %d cache entries", excess)
+            connection.execute(
+                "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM "
+                "entries ORDER BY last_used LIMIT ?)", (excess,))
@@ -0,0 +1,123 @@
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, Qt, QTimer
+from PyQt5.QtGui import QColor
+
+class SourceListModel(QAbstractListModel):
+    """Rows of the source list. Changes are collected and applied on the
+    next pass of the event loop as one insert and one dataChanged over
+    the affected range, so adding or updating thousands of sources costs
+    a single relayout and the view only renders the visible rows
+    """
+    ValidityRole = Qt.UserRole + 1
+    DurationRole = Qt.UserRole + 2
+    StatusRole = Qt.UserRole + 3
+
+    _role_keys = {
+        ValidityRole: "is_valid",
+        DurationRole: "duration",
+        StatusRole: "status"
+    }
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._rows = []
+        self._row_of = {}
+        self._pending = []
+        self._dirty = set()
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(0)
+        self._flush_timer.timeout.connect(self.flush)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._rows):
+            return None
+        row = self._rows[index.row()]
+        if role == Qt.DisplayRole:
+            if row["status"] in (None, "new"):
+                return row["file_name"]
+            return "{} [{}]".format(row["file_name"], row["status"])
+        if role == Qt.ForegroundRole:
+            return QColor(Qt.black if row["is_valid"] else Qt.red)
+        if role == Qt.ToolTipRole:
+            if row["duration"] is None or row["duration"] < 0:
+                return row["file_name"]
+            return "{} - {}s".format(row["file_name"], row["duration"])
+        if role in self._role_keys:
+            return row[self._role_keys[role]]
+        return None
+
+    def append(self, file_name, is_valid=True, duration=None, status=None):
+        if file_name in self._row_of:
+            self.set_values(file_name, is_valid=is_valid, duration=duration,
+                            status=status)
+            return
+        self._row_of[file_name] = len(self._rows) + len(self._pending)
+        self._pending.append({"file_name": file_name, "is_valid": is_valid,
+                              "duration": duration, "status": status})
+        self._flush_timer.start()
+
+    def file_name(self, row):
+        if 0 <= row < len(self._rows):
+            return self._rows[row]["file_name"]
+        return None
+
+    def flush(self):
+        """Apply the collected changes right away"""
+        self._flush_timer.stop()
+        if self._pending:
+            first = len(self._rows)
+            self.beginInsertRows(QModelIndex(), first,
+                                 first + len(self._pending) - 1)
+            self._rows.extend(self._pending)
+            self._pending = []
+            self.endInsertRows()
+        if self._dirty:
+            rows = [row for row in self._dirty if row < len(self._rows)]
+            self._dirty.clear()
+            if rows:
+                self.dataChanged.emit(self.index(min(rows)),
+                                      self.index(max(rows)))
+
+    def remove(self, row):
+        self.flush()
+        if not 0 <= row < len(self._rows):
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self._rows[row]
+        self._row_of = {values["file_name"]: i
+                        for i, values in enumerate(self._rows)}
+        self.endRemoveRows()
+
+    def reset(self, file_names):
+        self._flush_timer.stop()
+        self.beginResetModel()
+        self._rows = [{"file_name": file_name, "is_valid": True,
+                       "duration": None, "status": None}
+                      for file_name in file_names]
+        self._row_of = {file_name: i for i, file_name in enumerate(file_names)}
+        self._pending = []
+        self._dirty.clear()
+        self.endResetModel()
+
+    def set_values(self, file_name, **values):
+        """Update is_valid, duration and/or status of file_name. None
+        leaves a value unchanged
+        """
+        row = self._row_of.get(file_name)
+        if row is None:
+            return
+        if row < len(self._rows):
+            target = self._rows[row]
+        else:
+            target = self._pending[row - len(self._rows)]
+        for key, value in values.items():
+            if value is not None:
+                target[key] = value
+        if row < len(self._rows):
+            self._dirty.add(row)
+        self._flush_timer.start()
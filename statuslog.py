@@ -0,0 +1,60 @@
+from datetime import datetime
+import logging
+import logging.handlers
+
+from PyQt5.QtCore import pyqtSignal, QObject, QTimer
+
+from message import ProgressMessage
+
+class StatusLogBatcher(QObject):
+    """Collects status messages and hands them on as one batch of lines
+    per frame interval. Of several progress messages for the same source
+    within an interval only the latest is kept. Every line can also be
+    mirrored to a rotating file for post-mortems
+    """
+    lines_sig = pyqtSignal(list)
+
+    def __init__(self, interval=16, parent=None):
+        super().__init__(parent)
+        self._pending = []
+        # Position of the pending progress line of each source
+        self._progress_index = {}
+        self._mirror = None
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval)
+        self._timer.timeout.connect(self.flush)
+
+    def set_mirror(self, file_name, max_bytes=10 * 1024 ** 2,
+                   backup_count=3):
+        handler = logging.handlers.RotatingFileHandler(
+            file_name, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._mirror = logging.getLogger("StatusLog.mirror")
+        self._mirror.propagate = False
+        self._mirror.setLevel(logging.INFO)
+        self._mirror.addHandler(handler)
+
+    def append(self, message):
+        line = "{} - {}".format(datetime.now().strftime("%H:%M:%S"),
+                                message)
+        if isinstance(message, ProgressMessage):
+            index = self._progress_index.get(message.source)
+            if index is not None:
+                self._pending[index] = line
+                return
+            self._progress_index[message.source] = len(self._pending)
+        self._pending.append(line)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self):
+        self._timer.stop()
+        if not self._pending:
+            return
+        lines = self._pending
+        self._pending = []
+        self._progress_index.clear()
+        if self._mirror is not None:
+            self._mirror.info("\n".join(lines))
+        self.lines_sig.emit(lines)
@@ -0,0 +1,77 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import random
+import threading
+import time
+
+LOG = logging.getLogger("StatusWatcher")
+
+STATUS_TIMEOUT = "timeout"
+
+class StatusWatcher(object):
+    """Polls the encoding status of any number of uploads from a single
+    asyncio loop running on its own thread. get_status is a blocking call
+    returning the status string, or None on a retryable error. Polls back
+    off exponentially with jitter until a final status or the deadline
+    """
+    def __init__(self, get_status, pending_status="encoding",
+                 initial_delay=2.0, max_delay=30.0, jitter=0.25,
+                 deadline=900.0):
+        self.get_status = get_status
+        self.pending_status = pending_status
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+        self._loop = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                # The status requests themselves are short and blocking, a
+                # couple of threads are enough for any number of watchers
+                self._executor = ThreadPoolExecutor(max_workers=2)
+                thread = threading.Thread(target=self._loop.run_forever,
+                                          name="StatusWatcher", daemon=True)
+                thread.start()
+            return self._loop
+
+    def watch(self, name):
+        """Start watching name and return a concurrent.futures.Future
+        resolving to its final status, or STATUS_TIMEOUT
+        """
+        return asyncio.run_coroutine_threadsafe(self._watch(name),
+                                                self._ensure_loop())
+
+    async def _watch(self, name):
+        loop = asyncio.get_running_loop()
+        t_deadline = time.monotonic() + self.deadline
+        delay = self.initial_delay
+        while True:
+            # A hung request must not outlive the deadline either
+            remaining = t_deadline - time.monotonic()
+            try:
+                status = await asyncio.wait_for(
+                    loop.run_in_executor(self._executor, self.get_status,
+                                         name), max(remaining, 0))
+            except asyncio.TimeoutError:
+                LOG.warning("Status request of %s timed out", name)
+                return STATUS_TIMEOUT
+            except (OSError, ValueError):
+                LOG.exception("Unable to check the status of %s", name)
+                status = None
+            if status is None:
+                LOG.info("Retrying status of %s", name)
+            elif status != self.pending_status:
+                return status
+            remaining = t_deadline - time.monotonic()
+            if remaining <= 0:
+                return STATUS_TIMEOUT
+            sleep_time = delay * random.uniform(1 - self.jitter,
+                                                1 + self.jitter)
+            await asyncio.sleep(min(sleep_time, remaining))
+            delay = min(delay * 2, self.max_delay)
@@ -1,3 +1,10 @@
+import os.path
+import sys
+
+def app_dir():
+    """Directory holding presets.ini and the other per-install files"""
+    return os.path.realpath(os.path.dirname(sys.argv[0]))
+
 def try_parse_int64(string):
     try:
         ret = int(string)